@@ -1,28 +1,165 @@
 # File defines all of the classes for use in the chess_ai file
+import random
+import ctypes
+import mmap
+import os
+import struct
+from multiprocessing.sharedctypes import RawArray
+
+# bitboard names in piece index order (white pieces 0-5, black pieces 6-11)
+PIECE_NAMES = ('wp', 'wr', 'wn', 'wb', 'wq', 'wk', 'bp', 'br', 'bn', 'bb', 'bq', 'bk')
+PIECE_INDEX = {'P': 0, 'R': 1, 'N': 2, 'B': 3, 'Q': 4, 'K': 5} # offset of each piece letter, add 6 for black
+
+# Zobrist keys, one random 64-bit number per (piece, square) plus the side/castle/en passant extras
+# fixed seed so every worker process (and every run) agrees on the same keys
+zobrist_random = random.Random(2015)
+ZOBRIST_PIECES = [[zobrist_random.getrandbits(64) for square in range(64)] for piece in range(12)]
+ZOBRIST_WHITE_TURN = zobrist_random.getrandbits(64) # xor'd in when white is on the move
+ZOBRIST_CASTLE = [zobrist_random.getrandbits(64) for rights in range(16)] # one key per castle bitmask
+ZOBRIST_EP = [zobrist_random.getrandbits(64) for square in range(64)] # en passant target square
+
+# moves inside the search are packed into one int:
+#   bits 0-5 from square, 6-11 to square, 12-15 piece, 16-19 captured piece (NO_PIECE if none), 20-23 flags
+# squares count from a1 = 0 along the ranks to h8 = 63, pieces are indexes into PIECE_NAMES
+NO_MOVE = 0         # placeholder (a pawn moving a1-a1 can't happen)
+NO_PIECE = 12       # captured field for quiet moves
+MOVE_DOUBLE_PUSH = 1  # pawn moved two squares, sets the en passant square
+MOVE_CASTLE_KING = 2  # O-O, from/to are the king's squares
+MOVE_CASTLE_QUEEN = 3 # O-O-O
+MOVE_EN_PASSANT = 4   # pawn capture onto the en passant square
+MOVE_PROMOTION = 8    # set for promotions, low two bits pick the piece (PROMOTION_PIECES)
+PROMOTION_PIECES = (2, 3, 1, 4) # knight, bishop, rook, queen as white piece indexes
+PIECE_LETTERS = 'PRNBQK' # letter for each piece index (mod 6)
+SQUARE_NAMES = [chr(ord('a') + (square & 7)) + chr(ord('1') + (square >> 3)) for square in range(64)]
+
+# castle rights that survive a move touching each square (king or rook leaving home, rook captured at home)
+CASTLE_MASK = [0xF] * 64
+CASTLE_MASK[0] = 0xD   # a1 rook, white queenside
+CASTLE_MASK[4] = 0xC   # e1 king, all white castles
+CASTLE_MASK[7] = 0xE   # h1 rook, white kingside
+CASTLE_MASK[56] = 0x7  # a8 rook, black queenside
+CASTLE_MASK[60] = 0x3  # e8 king, all black castles
+CASTLE_MASK[63] = 0xB  # h8 rook, black kingside
+
+# attack tables, built once at import
+# steps are (rank, file) offsets, a step is only taken if it stays on the board
+def build_step_table(steps):
+  table = []
+  for index in range(64):
+    rank, file = index >> 3, index & 7
+    attacks = 0
+    for r, f in steps:
+      if(0 <= rank + r < 8 and 0 <= file + f < 8): attacks |= 1 << (((rank + r) << 3) + file + f)
+    table.append(attacks)
+  return table
+
+KNIGHT_ATTACKS = build_step_table(((2, 1), (2, -1), (-2, 1), (-2, -1), (1, 2), (1, -2), (-1, 2), (-1, -2)))
+KING_ATTACKS = build_step_table(((1, 1), (1, 0), (1, -1), (0, 1), (0, -1), (-1, 1), (-1, 0), (-1, -1)))
+PAWN_ATTACKS = (build_step_table(((1, 1), (1, -1))),    # squares a white pawn attacks
+                build_step_table(((-1, 1), (-1, -1))))  # squares a black pawn attacks
+
+# ray masks for the sliding pieces, RAYS[direction][square] is every square from there to the edge
+# the first four directions count up (blocker is the lowest bit), the last four count down (highest bit)
+RAY_STEPS = ((1, 0), (0, 1), (1, 1), (1, -1), (-1, 0), (0, -1), (-1, -1), (-1, 1))
+RAYS = [build_step_table([(r * i, f * i) for i in range(1, 8)]) for r, f in RAY_STEPS]
+ROOK_RAYS = (0, 1, 4, 5)   # north, east, south, west
+BISHOP_RAYS = (2, 3, 6, 7) # the diagonals
+
+RANK_3 = 0x0000000000FF0000 # white pawns land here after one step, can step again
+RANK_6 = 0x0000FF0000000000 # same for black
+LAST_RANKS = 0xFF000000000000FF # promotion squares for either side
+BOARD_MASK = 0xFFFFFFFFFFFFFFFF # python ints don't overflow, trim shifts back onto the board
+
+# squares a slider on index reaches along the given rays, stopping on (and including) the first blocker
+def slider_attacks(index, occupied, rays):
+  attacks = 0
+  for direction in rays:
+    ray = RAYS[direction][index]
+    blockers = ray & occupied
+    if(blockers):
+      if(direction < 4): first = (blockers & -blockers).bit_length() - 1 # nearest blocker going up
+      else: first = blockers.bit_length() - 1 # nearest blocker going down
+      ray ^= RAYS[direction][first] # cut the ray off behind it
+    attacks |= ray
+  return attacks
+
+# rook moves from a square given the occupancy
+def rook_attacks(index, occupied):
+  return slider_attacks(index, occupied, ROOK_RAYS)
+
+# bishop moves from a square given the occupancy
+def bishop_attacks(index, occupied):
+  return slider_attacks(index, occupied, BISHOP_RAYS)
+
+# every square a rook/bishop could reach from a square on an empty board, a cheap test before the real lookup
+ROOK_LINES = [rook_attacks(index, 0) for index in range(64)]
+BISHOP_LINES = [bishop_attacks(index, 0) for index in range(64)]
+
+# squares strictly between two squares on a shared rank, file or diagonal (0 if they don't share one)
+BETWEEN = [[0] * 64 for square in range(64)]
+for direction in range(8):
+  for index in range(64):
+    ray = RAYS[direction][index]
+    for target in range(64):
+      if((ray >> target) & 1): BETWEEN[index][target] = ray & ~RAYS[direction][target] & ~(1 << target)
+
+# piece values from white's side (Kauffman's 2012 values), the kings never leave the board so theirs cancel out
+PIECE_VALUES = (100, 525, 350, 350, 1000, 100000, -100, -525, -350, -350, -1000, -100000)
+MATE_VALUE = 90000 # score for delivering mate, minus the plies it takes (sooner is better)
+MATE_BOUND = MATE_VALUE - 1000 # past this a score is a mate (or tablebase win), no line gets near 1000 plies
+
+# Board_State.snapshot layout: the occupied squares as one bitboard, a metadata word with the en passant square + 1
+#   (7 bits), castle rights (4), turn and ai color, then a 4-bit piece (index into PIECE_NAMES) for each occupied
+#   square from a1 up, two to a byte (a full board is 26 bytes, the key, material and piece count are worked out again)
+SNAPSHOT_HEADER = struct.Struct('<QH')
+
+# number of set bits in a bitboard
+# python 3.10+ ints count their own bits, otherwise add up a 16-bit lookup table four times
+POPCOUNT_16 = [bin(word).count("1") for word in range(1 << 16)]
+if(hasattr(int, 'bit_count')):
+  popcount = int.bit_count
+else:
+  def popcount(board):
+    return (POPCOUNT_16[board & 0xFFFF] + POPCOUNT_16[(board >> 16) & 0xFFFF] +
+            POPCOUNT_16[(board >> 32) & 0xFFFF] + POPCOUNT_16[board >> 48])
+
+# pack a move into its int form
+def encode_move(old_index, new_index, piece, captured = NO_PIECE, flags = 0):
+  return old_index | (new_index << 6) | (piece << 12) | (captured << 16) | (flags << 20)
+
+# turn an int move into long-algebraic notation (only needed at the edges of the ai)
+def move_to_string(move):
+  if(move == NO_MOVE): return ""
+  flags = move >> 20
+  if(flags == MOVE_CASTLE_KING): return "O-O"
+  if(flags == MOVE_CASTLE_QUEEN): return "O-O-O"
+  piece = ((move >> 12) & 15) % 6
+  if(((move >> 16) & 15) != NO_PIECE): capture = 'x'
+  else: capture = '-'
+  text = SQUARE_NAMES[move & 63] + capture + SQUARE_NAMES[(move >> 6) & 63]
+  if(piece): text = PIECE_LETTERS[piece] + text # no letter for pawns
+  if(flags & MOVE_PROMOTION): text += '=' + PIECE_LETTERS[PROMOTION_PIECES[flags & 3]]
+  return text
 
 # storage class for the bit boards
-class Board_State:
-  # declare each piece board as a 64-bit unsigned integer (assume empty board)
-  wp = 0
-  wr = 0
-  wn = 0
-  wb = 0
-  wq = 0
-  wk = 0
-  bp = 0
-  br = 0
-  bn = 0
-  bb = 0
-  bq = 0
-  bk = 0
-  ep = 0 # en passant rule
-  turn = True       # is it our turn?
-  ai_color = True   # what color are we? (true = white, false = black)
-  castle = 0        # castle avaliability-bits[(0/1 white, 0/2 king side, 1/3 queen side)]
-  # not doing stalemate counters
+class Board_State(object):
+  # fixed attribute set, no per-instance __dict__ (PIECE_NAMES, then the metadata)
+  __slots__ = PIECE_NAMES + ('ep', 'turn', 'ai_color', 'castle', 'hash', 'material', 'piece_count', 'history')
 
   # construct the state from a FEN string and color
   def __init__(self, fen_board = None, color = True):
+    # declare each piece board as a 64-bit unsigned integer (assume empty board)
+    self.wp = self.wr = self.wn = self.wb = self.wq = self.wk = 0
+    self.bp = self.br = self.bn = self.bb = self.bq = self.bk = 0
+    self.ep = 0 # en passant rule
+    self.turn = True       # is it our turn?
+    self.ai_color = True   # what color are we? (true = white, false = black)
+    self.castle = 0        # castle avaliability-bits[(0/1 white, 0/2 king side, 1/3 queen side)]
+    self.hash = 0          # zobrist key of the position, kept up to date by execute_move
+    self.material = 0      # sum of PIECE_VALUES on the board (white's side), kept up to date by make_move
+    self.piece_count = 0   # pieces on the board, kings included
+    self.history = []      # zobrist keys of the positions before each move made, oldest first (repetitions)
+    # not doing stalemate counters
     if(fen_board == None): # empty constructor
       return
     square = 0;
@@ -82,9 +219,34 @@ class Board_State:
           else: 
             ep_file = (ord(c) - ord('a'))  # cache rank
         elif(square == 73): 
-          self.ep = 1 << ep_file + (ord(c) - ord('0')) << 8  # store ep
+          self.ep = 1 << (ep_file + ((ord(c) - ord('1')) << 3))  # store ep
         # Not doing the 50-move stalemate counters, fuck it
         square += 1
+    self.hash = self.compute_hash() # key the finished position
+    self.material, self.piece_count = self.compute_material() # running totals start here
+
+  # build the zobrist key from scratch (execute_move keeps it updated incrementally after this)
+  def compute_hash(self):
+    key = 0
+    for piece in range(12):
+      board = getattr(self, PIECE_NAMES[piece])
+      for square in range(64):
+        if((board >> square) & 1): key ^= ZOBRIST_PIECES[piece][square]
+    if(self.turn == self.ai_color): key ^= ZOBRIST_WHITE_TURN # white on the move
+    key ^= ZOBRIST_CASTLE[self.castle]
+    for square in range(64):
+      if((self.ep >> square) & 1): key ^= ZOBRIST_EP[square]
+    return key
+
+  # count the material from scratch, returns (material, piece count)
+  def compute_material(self):
+    material = 0
+    piece_count = 0
+    for piece in range(12):
+      count = popcount(getattr(self, PIECE_NAMES[piece]))
+      material += count * PIECE_VALUES[piece]
+      piece_count += count
+    return (material, piece_count)
 
   # copy constructor
   def copy_board(self, other):
@@ -104,92 +266,191 @@ class Board_State:
     self.turn = other.turn
     self.ai_color = other.ai_color
     self.castle = other.castle
+    self.hash = other.hash
+    self.material = other.material
+    self.piece_count = other.piece_count
+    self.history = list(other.history)
+
+  # compact immutable copy of the position (a string, SNAPSHOT_HEADER then the occupied squares' pieces)
+  # snapshots compare equal exactly when the positions are, so they can key tables directly
+  def snapshot(self):
+    pieces = [0] * 64
+    occupied = 0
+    for piece in range(12):
+      board = getattr(self, PIECE_NAMES[piece])
+      occupied |= board
+      while(board):
+        low = board & -board
+        pieces[low.bit_length() - 1] = piece
+        board ^= low
+    packed = bytearray((popcount(occupied) + 1) >> 1)
+    index = 0
+    board = occupied
+    while(board):
+      low = board & -board
+      packed[index >> 1] |= pieces[low.bit_length() - 1] << ((index & 1) << 2)
+      board ^= low
+      index += 1
+    meta = self.ep.bit_length() | (self.castle << 7) | (int(self.turn) << 11) | (int(self.ai_color) << 12)
+    return SNAPSHOT_HEADER.pack(occupied, meta) + bytes(packed)
+
+  # put the position back from a snapshot (the move history isn't in it, it starts empty)
+  def restore(self, snapshot):
+    occupied, meta = SNAPSHOT_HEADER.unpack_from(snapshot)
+    packed = bytearray(snapshot[SNAPSHOT_HEADER.size:])
+    boards = [0] * 12
+    index = 0
+    while(occupied):
+      low = occupied & -occupied
+      boards[(packed[index >> 1] >> ((index & 1) << 2)) & 15] |= low
+      occupied ^= low
+      index += 1
+    (self.wp, self.wr, self.wn, self.wb, self.wq, self.wk, self.bp, self.br, self.bn, self.bb, self.bq, self.bk) = boards
+    ep_square = meta & 0x7F
+    self.ep = (1 << (ep_square - 1)) if ep_square else 0
+    self.castle = (meta >> 7) & 0xF
+    self.turn = bool((meta >> 11) & 1)
+    self.ai_color = bool((meta >> 12) & 1)
+    self.hash = self.compute_hash()
+    self.material, self.piece_count = self.compute_material()
+    self.history = []
+
+  # same position (pieces, side on the move, castling, en passant), the key is checked first
+  def __eq__(self, other):
+    return isinstance(other, Board_State) and self.hash == other.hash and self.snapshot() == other.snapshot()
+
+  def __ne__(self, other):
+    return not self.__eq__(other)
+
+  # the zobrist key, don't change a state while it's in a set or dict (store a snapshot instead)
+  def __hash__(self):
+    return hash(self.hash)
+
+  # has this position come up before in the moves made on this board (same side on the move, so every
+  #   other entry, and at least four plies back)
+  def is_repetition(self):
+    return self.hash in self.history[-4::-2]
   
   # Execute a  move (swap indicates that we want to take turns)
+  # takes long-algebraic strings as well as int moves
   def execute_move(self, move, swap=True):
-    if(len(move) < 3): return # bad input
+    if(isinstance(move, str)): move = self.parse_move(move)
+    self.make_move(move, swap) # same thing, we just don't need to take it back
+
+  # Execute an int move in place and return an undo record for unmake_move
+  # the record is (changed boards, castle, en passant, hash, turn, material, piece count), changed boards being a list of
+  #   (piece index, bitboard before the move) for every board the move touched
+  def make_move(self, move, swap=True):
+    changed = [] # bitboards we overwrite, in the order we overwrote them
+    undo = (changed, self.castle, self.ep, self.hash, self.turn, self.material, self.piece_count)
+    self.history.append(self.hash)
+    if(move == NO_MOVE): return undo # bad input
+    old_index = move & 63
+    new_index = (move >> 6) & 63
+    piece = (move >> 12) & 15
+    captured = (move >> 16) & 15
+    flags = move >> 20
+    if(self.ep): # en passant only lasts one move
+      self.hash ^= ZOBRIST_EP[self.ep.bit_length() - 1]
+      self.ep = 0
+    if(captured != NO_PIECE): # remove the captured piece
+      if(flags == MOVE_EN_PASSANT): victim_index = (old_index & 0x38) | (new_index & 7) # pawn beside us
+      else: victim_index = new_index
+      board = getattr(self, PIECE_NAMES[captured])
+      changed.append((captured, board))
+      setattr(self, PIECE_NAMES[captured], board & ~(1 << victim_index))
+      self.hash ^= ZOBRIST_PIECES[captured][victim_index]
+      self.material -= PIECE_VALUES[captured]
+      self.piece_count -= 1
+    self.move_piece(piece, old_index, new_index, changed)
+    if(flags == MOVE_DOUBLE_PUSH): # square the pawn skipped can be taken en passant
+      ep_index = (old_index + new_index) >> 1
+      self.ep = 1 << ep_index
+      self.hash ^= ZOBRIST_EP[ep_index]
+    elif(flags == MOVE_CASTLE_KING): # bring the rook around, Rh1-f1
+      self.move_piece(piece - 4, new_index + 1, new_index - 1, changed)
+    elif(flags == MOVE_CASTLE_QUEEN): # Ra1-d1
+      self.move_piece(piece - 4, new_index - 2, new_index + 1, changed)
+    elif(flags & MOVE_PROMOTION): # swap the pawn for the new piece
+      promoted = PROMOTION_PIECES[flags & 3] + piece # piece is the pawn index, 0 or 6
+      board = getattr(self, PIECE_NAMES[piece])
+      setattr(self, PIECE_NAMES[piece], board & ~(1 << new_index)) # pawn board is already in changed
+      self.hash ^= ZOBRIST_PIECES[piece][new_index]
+      board = getattr(self, PIECE_NAMES[promoted])
+      changed.append((promoted, board))
+      setattr(self, PIECE_NAMES[promoted], board | (1 << new_index))
+      self.hash ^= ZOBRIST_PIECES[promoted][new_index]
+      self.material += PIECE_VALUES[promoted] - PIECE_VALUES[piece]
+    self.castle = self.castle & CASTLE_MASK[old_index] & CASTLE_MASK[new_index]
+    if(self.castle != undo[1]): self.hash ^= ZOBRIST_CASTLE[undo[1]] ^ ZOBRIST_CASTLE[self.castle]
+    if(swap): 
+      self.turn = not self.turn # next player's turn
+      self.hash ^= ZOBRIST_WHITE_TURN
+    return undo
+
+  # Pass the turn without moving (null move pruning), returns an undo record for unmake_move
+  def make_null_move(self):
+    undo = ([], self.castle, self.ep, self.hash, self.turn, self.material, self.piece_count)
+    self.history.append(self.hash)
+    if(self.ep): # the chance to take en passant is gone
+      self.hash ^= ZOBRIST_EP[self.ep.bit_length() - 1]
+      self.ep = 0
+    self.turn = not self.turn
+    self.hash ^= ZOBRIST_WHITE_TURN
+    return undo
+
+  # Take back a move using the record make_move returned
+  def unmake_move(self, undo):
+    changed, self.castle, self.ep, self.hash, self.turn, self.material, self.piece_count = undo
+    self.history.pop()
+    for piece, board in reversed(changed):
+      setattr(self, PIECE_NAMES[piece], board) # put the old bitboard back
+
+  # turn a long-algebraic string ("Nb1-c3", "e2xe4", "O-O", "e7-e8=Q") into an int move for this position
+  def parse_move(self, move):
+    if(len(move) < 3): return NO_MOVE # bad input
+    if(self.turn == self.ai_color): offset = 0 # white piece boards
+    else: offset = 6 # black piece boards
+    if(move[0] == 'O'): # castle, king's squares plus a flag
+      if(offset): back_rank = 56
+      else: back_rank = 0
+      if(move.startswith("O-O-O")): return encode_move(back_rank + 4, back_rank + 2, offset + 5, NO_PIECE, MOVE_CASTLE_QUEEN)
+      return encode_move(back_rank + 4, back_rank + 6, offset + 5, NO_PIECE, MOVE_CASTLE_KING)
     if(move[0] >= 'A' and move[0] <= 'Z'):  # capital letters are pieces
-      if(move[0] == 'O'): # castle, manually execute swap
-        if (len(move) == 3): # Kingside
-          if(self.turn): # white
-            self.execute_move("Ke1-g1",False)
-            self.execute_move("Rh1-f1",False)
-          else: # black
-            self.execute_move("Ke8-g8",False)
-            self.execute_move("Rh8-f8",False)
-        else: # Queenside
-          if(self.turn): # white
-            self.execute_move("Ke1-c1",False)
-            self.execute_move("Ra1-d1",False)
-          else: # black
-            self.execute_move("Ke8-c8",False)
-            self.execute_move("Rh8-d8",False)
-        return # break method
-      piece_type = move[0]
-      old_rank_file = (ord(move[2])-ord('0'),ord(move[1])-ord('a')+1) # starting location
-      new_rank_file = (ord(move[5])-ord('0'),ord(move[4])-ord('a')+1) # new location
-      capture = (move[3] == 'x') # was there a capture?
+      piece = PIECE_INDEX[move[0]] + offset
+      move = move[1:]
     else:
-      piece_type = 'P'
-      old_rank_file = (ord(move[1])-ord('0'),ord(move[0])-ord('a')+1) # starting location
-      new_rank_file = (ord(move[4])-ord('0'),ord(move[3])-ord('a')+1) # new location
-      capture = (move[2] == 'x') # was there a capture?
-
-    old_square = get_square(old_rank_file) # get old square
-    new_square = get_square(new_rank_file) # get new square
-      
-    if(self.turn == self.ai_color):  # white's turn
-      if(piece_type == 'P'):
-        self.wp = (self.wp & ~old_square) | new_square # remove old location, set new one
-      if(piece_type == 'R'):
-        self.wr = (self.wr & ~old_square) | new_square # remove old location, set new one
-        if(old_rank_file[1] == 8): # kingside rook
-          self.castle = self.castle & 0xE # remove castle availability
-        else: # queenside rook 
-          self.castle = self.castle & 0xD 
-      if(piece_type == 'N'):
-        self.wn = (self.wn & ~old_square) | new_square # remove old location, set new one
-      if(piece_type == 'B'):
-        self.wb = (self.wb & ~old_square) | new_square # remove old location, set new one
-      if(piece_type == 'Q'):
-        self.wq = (self.wq & ~old_square) | new_square # remove old location, set new one
-      if(piece_type == 'K'):
-        self.wk = (self.wk & ~old_square) | new_square # remove old location, set new one
-        self.castle = (self.castle & 0xC) # remove castle avaliability
-      if(capture):
-        self.bp = self.bp & ~new_square # remove the piece
-        self.br = self.br & ~new_square # remove the piece
-        self.bn = self.bn & ~new_square # remove the piece
-        self.bb = self.bb & ~new_square # remove the piece
-        self.bq = self.bq & ~new_square # remove the piece
-        self.bk = self.bk & ~new_square # remove the piece
-    
-    else: # black's turn
-      if(piece_type == 'P'):
-        self.bp = (self.bp & ~old_square) | new_square # remove old location, set new one
-      if(piece_type == 'R'):
-        self.br = (self.br & ~old_square) | new_square # remove old location, set new one
-        if(old_rank_file[1] == 8): # kingside rook
-          self.castle = self.castle & 0xB # remove castle availability
-        else: # queenside rook 
-          self.castle = self.castle & 0x7 
-      if(piece_type == 'N'):
-        self.bn = (self.bn & ~old_square) | new_square # remove old location, set new one
-      if(piece_type == 'B'):
-        self.bb = (self.bb & ~old_square) | new_square # remove old location, set new one
-      if(piece_type == 'Q'):
-        self.bq = (self.bq & ~old_square) | new_square # remove old location, set new one
-      if(piece_type == 'K'):
-        self.bk = (self.bk & ~old_square) | new_square # remove old location, set new one
-      if(capture):
-        self.wp = self.wp & ~new_square # remove the piece
-        self.wr = self.wr & ~new_square # remove the piece
-        self.wn = self.wn & ~new_square # remove the piece
-        self.wb = self.wb & ~new_square # remove the piece
-        self.wq = self.wq & ~new_square # remove the piece
-        self.wk = self.wk & ~new_square # remove the piece
-    
-    if(swap): self.turn = not self.turn # next player's turn
+      piece = offset # pawn
+    old_index = ((ord(move[1])-ord('1')) << 3) + ord(move[0])-ord('a') # starting location
+    new_index = ((ord(move[4])-ord('1')) << 3) + ord(move[3])-ord('a') # new location
+    captured = self.get_piece_at(new_index)
+    flags = 0
+    if(piece == offset): # pawn specials
+      if(old_index - new_index == 16 or new_index - old_index == 16): flags = MOVE_DOUBLE_PUSH
+      elif((old_index ^ new_index) & 7 and captured == NO_PIECE and self.ep == 1 << new_index):
+        flags = MOVE_EN_PASSANT
+        captured = 6 - offset # the enemy pawn
+      elif(new_index >= 56 or new_index < 8): # promotion, queen unless told otherwise
+        flags = MOVE_PROMOTION | 3
+        if('=' in move): flags = MOVE_PROMOTION | PROMOTION_PIECES.index(PIECE_INDEX[move[move.index('=')+1]])
+    return encode_move(old_index, new_index, piece, captured, flags)
+
+  # index of the piece on a square, NO_PIECE if it's empty
+  def get_piece_at(self, index):
+    square = 1 << index
+    for piece in range(12):
+      if(getattr(self, PIECE_NAMES[piece]) & square): return piece
+    return NO_PIECE
+
+  # move one piece between square numbers, recording the old board for unmake_move
+  def move_piece(self, piece, old_index, new_index, changed):
+    board = getattr(self, PIECE_NAMES[piece])
+    changed.append((piece, board))
+    new_board = (board & ~(1 << old_index)) | (1 << new_index) # remove old location, set new one
+    setattr(self, PIECE_NAMES[piece], new_board)
+    flipped = board ^ new_board # bits that actually changed, keep the zobrist key in step
+    if((flipped >> old_index) & 1): self.hash ^= ZOBRIST_PIECES[piece][old_index]
+    if((flipped >> new_index) & 1): self.hash ^= ZOBRIST_PIECES[piece][new_index]
 
   # return the locations of all white peices (int bitmaps are additive)
   def get_white_pieces(self):
@@ -203,22 +464,336 @@ class Board_State:
   def get_all_pieces(self):
     return self.get_black_pieces() + self.get_white_pieces()
 
+  # bitboard of one side's pieces attacking a square, with occupied as the blockers
+  def get_attackers(self, square, by_white, occupied):
+    if(by_white): 
+      pawns, rooks, knights, bishops, queens, king = self.wp, self.wr, self.wn, self.wb, self.wq, self.wk
+      pawn_side = 1 # a white pawn attacks square if a black pawn on square would attack it
+    else: 
+      pawns, rooks, knights, bishops, queens, king = self.bp, self.br, self.bn, self.bb, self.bq, self.bk
+      pawn_side = 0
+    attackers = (PAWN_ATTACKS[pawn_side][square] & pawns) | (KNIGHT_ATTACKS[square] & knights) | (KING_ATTACKS[square] & king)
+    if(ROOK_LINES[square] & (rooks | queens)): attackers |= rook_attacks(square, occupied) & (rooks | queens)
+    if(BISHOP_LINES[square] & (bishops | queens)): attackers |= bishop_attacks(square, occupied) & (bishops | queens)
+    return attackers
+
+  # does one side attack a square (cheap pieces first, stops at the first attacker)
+  def is_square_attacked(self, square, by_white):
+    if(by_white): 
+      pawns, rooks, knights, bishops, queens, king = self.wp, self.wr, self.wn, self.wb, self.wq, self.wk
+      pawn_side = 1
+    else: 
+      pawns, rooks, knights, bishops, queens, king = self.bp, self.br, self.bn, self.bb, self.bq, self.bk
+      pawn_side = 0
+    if((PAWN_ATTACKS[pawn_side][square] & pawns) or (KNIGHT_ATTACKS[square] & knights) or (KING_ATTACKS[square] & king)):
+      return True
+    rooks |= queens
+    bishops |= queens
+    if(ROOK_LINES[square] & rooks and rook_attacks(square, self.get_all_pieces()) & rooks): return True
+    return bool(BISHOP_LINES[square] & bishops and bishop_attacks(square, self.get_all_pieces()) & bishops)
+
+  # is the side on the move in check
+  def in_check(self):
+    if(self.turn == self.ai_color): return self.is_square_attacked(self.wk.bit_length() - 1, False) # white to move
+    return self.is_square_attacked(self.bk.bit_length() - 1, True)
+
+# bound types for transposition table entries
+TT_EXACT = 0  # score is the true minimax value
+TT_LOWER = 1  # search failed high, true value is at least the score
+TT_UPPER = 2  # search failed low, true value is at most the score
+TT_ENTRY_BYTES = 160 # rough cost of one stored entry (tuple + long key + slot), used for the memory cap
+SHARED_ENTRY_BYTES = 16 # two 64-bit words per entry in the shared table
+# packed layout of a shared entry's data word
+SHARED_SCORE_SHIFT = 24   # move in the low 24 bits
+SHARED_SCORE_OFFSET = 1 << 20 # scores are stored +2^20 so they fit 21 unsigned bits
+SHARED_DEPTH_SHIFT = 45
+SHARED_BOUND_SHIFT = 53
+SHARED_GENERATION_SHIFT = 55
+
+# mate (and tablebase) scores count plies from the root, which depends on where the position came up, so the
+#   tables keep them counted from the position itself and put the ply back when they're read
+def score_to_table(score, ply):
+  if(score > MATE_BOUND): return score + ply
+  if(score < -MATE_BOUND): return score - ply
+  return score
+
+def score_from_table(score, ply):
+  if(score > MATE_BOUND): return score - ply
+  if(score < -MATE_BOUND): return score + ply
+  return score
+
+# fixed size hash table of searched positions, indexed by the low bits of the zobrist key
+# entries are tuples of (key, depth, bound, score, move, generation)
+class Transposition_Table:
+  def __init__(self, max_mb = 32):
+    slots = 1
+    while((slots << 1) * TT_ENTRY_BYTES <= (max_mb << 20)): # largest power of two under the cap
+      slots <<= 1
+    self.max_mb = max_mb
+    self.mask = slots - 1
+    self.entries = [None] * slots # allocated once, never grows
+    self.generation = 0   # bumped every search so stale entries can be replaced
+    self.ai_color = None  # scores are relative to the ai, so a color change invalidates the table
+    self.reset_stats()
+
+  # zero the hit rate counters
+  def reset_stats(self):
+    self.probes = 0   # lookups
+    self.hits = 0     # lookups that found the position
+    self.stores = 0   # entries written
+    self.rejects = 0  # writes refused by the replacement policy
+
+  # call before each new search from the root
+  def new_search(self, ai_color):
+    if(ai_color != self.ai_color): 
+      self.clear()
+      self.ai_color = ai_color
+    self.generation = (self.generation + 1) & 0xFF
+    self.reset_stats()
+
+  # throw away every entry
+  def clear(self):
+    self.entries = [None] * (self.mask + 1)
+
+  # return the entry for a position or None, ply is the position's distance from the root (for mate scores)
+  def probe(self, key, ply = 0):
+    self.probes += 1
+    entry = self.entries[key & self.mask]
+    if(entry is not None and entry[0] == key):
+      self.hits += 1
+      score = score_from_table(entry[3], ply)
+      if(score != entry[3]): entry = entry[:3] + (score,) + entry[4:]
+      return entry
+    return None
+
+  # store a search result, depth-preferred (keep the deeper search unless the old one is stale)
+  # ply is the position's distance from the root (for mate scores)
+  def store(self, key, depth, bound, score, move, ply = 0):
+    score = score_to_table(score, ply)
+    index = key & self.mask
+    old = self.entries[index]
+    if(old is not None and old[0] != key and old[1] > depth and old[5] == self.generation):
+      self.rejects += 1 # deeper result from this search lives here, keep it
+      return
+    if(not move and old is not None and old[0] == key): 
+      move = old[4] # bound without a best move, keep the one we already knew
+    self.entries[index] = (key, depth, bound, score, move, self.generation)
+    self.stores += 1
+
+  # counters as a tuple (probes, hits, stores, rejects) so workers can report deltas
+  def get_stats(self):
+    return (self.probes, self.hits, self.stores, self.rejects)
+
+  # number of occupied slots
+  def get_fill(self):
+    return (self.mask + 1) - self.entries.count(None)
+
+# transposition table in shared memory, so every worker process reads and writes the same entries (lazy smp)
+# same interface as Transposition_Table, entries still come back as (key, depth, bound, score, move, generation)
+# each slot is two words, (key ^ data, data), written without a lock: a slot torn by two processes
+#   writing at once no longer xors back to its key, so the probe just misses instead of returning garbage
+# the hit counters stay per process
+class Shared_Transposition_Table(Transposition_Table):
+  def __init__(self, max_mb = 32):
+    slots = 1
+    while((slots << 1) * SHARED_ENTRY_BYTES <= (max_mb << 20)): # largest power of two under the cap
+      slots <<= 1
+    self.max_mb = max_mb
+    self.mask = slots - 1
+    self.entries = RawArray(ctypes.c_uint64, slots * 2) # zeroed, allocated once and handed to the workers
+    self.info = RawArray(ctypes.c_int, 2) # (generation, ai color or -1), shared so the workers agree
+    self.info[1] = -1
+    self.reset_stats()
+
+  # call before each new search from the root (main process only, workers just follow the shared generation)
+  def new_search(self, ai_color):
+    if(int(ai_color) != self.info[1]):
+      self.clear()
+      self.info[1] = int(ai_color)
+    self.info[0] = (self.info[0] + 1) & 0xFF
+    self.reset_stats()
+
+  # throw away every entry
+  def clear(self):
+    ctypes.memset(self.entries, 0, ctypes.sizeof(self.entries))
+
+  # return the entry for a position or None, ply is the position's distance from the root (for mate scores)
+  def probe(self, key, ply = 0):
+    self.probes += 1
+    index = (key & self.mask) << 1
+    data = self.entries[index + 1]
+    if(self.entries[index] ^ data != key or not data): return None
+    self.hits += 1
+    score = score_from_table(((data >> SHARED_SCORE_SHIFT) & 0x1FFFFF) - SHARED_SCORE_OFFSET, ply)
+    return (key, (data >> SHARED_DEPTH_SHIFT) & 0xFF, (data >> SHARED_BOUND_SHIFT) & 3, score, data & 0xFFFFFF, 
+      data >> SHARED_GENERATION_SHIFT)
+
+  # store a search result, depth-preferred (keep the deeper search unless the old one is stale)
+  # ply is the position's distance from the root (for mate scores)
+  def store(self, key, depth, bound, score, move, ply = 0):
+    score = score_to_table(score, ply)
+    index = (key & self.mask) << 1
+    generation = self.info[0]
+    old = self.entries[index + 1]
+    if(old):
+      same = (self.entries[index] ^ old == key)
+      if(not same and (old >> SHARED_DEPTH_SHIFT) & 0xFF > depth and old >> SHARED_GENERATION_SHIFT == generation):
+        self.rejects += 1 # deeper result from this search lives here, keep it
+        return
+      if(not move and same): 
+        move = old & 0xFFFFFF # bound without a best move, keep the one we already knew
+    data = (move | (score + SHARED_SCORE_OFFSET) << SHARED_SCORE_SHIFT | depth << SHARED_DEPTH_SHIFT | 
+      bound << SHARED_BOUND_SHIFT | generation << SHARED_GENERATION_SHIFT)
+    self.entries[index] = key ^ data
+    self.entries[index + 1] = data
+    self.stores += 1
+
+  # number of occupied slots
+  def get_fill(self):
+    return sum(1 for index in range(1, len(self.entries), 2) if self.entries[index])
+
+# opening book records, sorted by key: (position key, int move, weight)
+BOOK_RECORD = struct.Struct('<QIH')
+
+# key a position for the book: the zobrist key without the en passant square, since a FEN often
+#   leaves it out after a double push and we still want to find the position
+def get_book_key(state):
+  key = state.hash
+  if(state.ep): key ^= ZOBRIST_EP[state.ep.bit_length() - 1]
+  return key
+
+# read only opening book, the file is memory mapped and binary searched so it never gets loaded whole
+class Opening_Book:
+  def __init__(self, path):
+    self.path = path
+    self.file = open(path, 'rb')
+    self.count = os.fstat(self.file.fileno()).st_size // BOOK_RECORD.size # number of records
+    if(self.count): self.data = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+    else: self.data = None # can't map an empty file
+
+  # every (move, weight) stored for a position, empty if it isn't in the book
+  def get_moves(self, state):
+    key = get_book_key(state)
+    low = 0 # first record whose key isn't below ours
+    high = self.count
+    while(low < high):
+      middle = (low + high) >> 1
+      if(struct.unpack_from('<Q', self.data, middle * BOOK_RECORD.size)[0] < key): low = middle + 1
+      else: high = middle
+    moves = []
+    while(low < self.count):
+      record = BOOK_RECORD.unpack_from(self.data, low * BOOK_RECORD.size)
+      if(record[0] != key): break
+      moves.append((record[1], record[2]))
+      low += 1
+    return moves
+
+  def close(self):
+    if(self.data is not None): self.data.close()
+    self.file.close()
+
+# endgame tablebases, one file per ending: strong king + one piece against a lone king
+# every position is stored as a small number, bit packed: 0 illegal, 1 draw, otherwise 2 + plies to mate
+#   (counted from the side to move, the strong side always wins or draws)
+# positions are stored with the strong side as white, so a black strong side is probed with the ranks flipped
+TB_MAGIC = b'CTB1'
+TB_HEADER = struct.Struct('<4sBI') # magic, bits per entry, entry count
+TB_ENDINGS = {'kqk': 4, 'krk': 1, 'kpk': 0} # file name to the strong side's piece index
+TB_WIN = MATE_VALUE # a won tablebase position is a mate, minus the plies to it, same as one the search finds
+TB_TRIANGLE = [square for square in range(64) if (square & 7) < 4 and (square >> 3) <= (square & 7)] # a1-d1-d4
+
+# index of a position in a tablebase file (strong_to_move, then the squares with the strong side as white)
+# pawnless endings use all 8 board symmetries to put the strong king in the a1-d1-d4 triangle,
+#   pawn endings can only mirror the files, so the strong king goes on the a-d files
+def get_tablebase_index(pawns, strong_to_move, strong_king, piece, weak_king):
+  if(strong_king & 4): # e-h files, mirror
+    strong_king ^= 7
+    piece ^= 7
+    weak_king ^= 7
+  side = 0 if strong_to_move else 1
+  if(pawns): return (((side << 5) | (strong_king >> 3) << 2 | (strong_king & 3)) << 12) | (piece << 6) | weak_king
+  if(strong_king & 32): # ranks 5-8, flip
+    strong_king ^= 56
+    piece ^= 56
+    weak_king ^= 56
+  if((strong_king >> 3) > (strong_king & 7)): # above the diagonal, transpose
+    strong_king = ((strong_king & 7) << 3) | (strong_king >> 3)
+    piece = ((piece & 7) << 3) | (piece >> 3)
+    weak_king = ((weak_king & 7) << 3) | (weak_king >> 3)
+  return ((side * 10 + TB_TRIANGLE.index(strong_king)) << 12) | (piece << 6) | weak_king
+
+# number of entries in a tablebase file
+def get_tablebase_size(pawns):
+  if(pawns): return 2 * 32 * 64 * 64
+  return 2 * 10 * 64 * 64
+
+# read a bit packed table file into (bits per entry, data)
+def load_tablebase(path):
+  data = open(path, 'rb').read()
+  magic, bits, count = TB_HEADER.unpack_from(data)
+  if(magic != TB_MAGIC): raise ValueError('not a tablebase file: ' + path)
+  return (bits, bytearray(data[TB_HEADER.size:]) + bytearray(2)) # padding so a read never runs off the end
+
+# exact scores for the tablebase endings, any table file missing from the folder is just not probed
+class Endgame_Tablebase:
+  def __init__(self, folder):
+    self.tables = {} # strong piece index to (bits, data)
+    for name in TB_ENDINGS:
+      path = os.path.join(folder, name + '.tb')
+      if(os.path.exists(path)): self.tables[TB_ENDINGS[name]] = load_tablebase(path)
+
+  # value stored for a position, see the file layout above
+  def read(self, piece, strong_to_move, strong_king, piece_square, weak_king):
+    bits, data = self.tables[piece]
+    index = get_tablebase_index(piece == 0, strong_to_move, strong_king, piece_square, weak_king) * bits
+    byte = index >> 3
+    return ((data[byte] | data[byte+1] << 8 | data[byte+2] << 16) >> (index & 7)) & ((1 << bits) - 1)
+
+  # score a king + piece vs king position for the ai, ply is the distance from the root (sooner mates score higher)
+  # returns None if there's no table for it or it can't happen in a game (let the search take the king)
+  def probe(self, state, ply):
+    if(state.piece_count != 3): return None
+    white = state.get_white_pieces() ^ state.wk # the strong side's piece, if white has it
+    if(white):
+      piece = PIECE_NAMES.index(next(name for name in PIECE_NAMES[:5] if getattr(state, name)))
+      strong_king, piece_square, weak_king = state.wk.bit_length()-1, white.bit_length()-1, state.bk.bit_length()-1
+    else: # black is strong, flip the ranks so it plays up the board
+      black = state.get_black_pieces() ^ state.bk
+      piece = PIECE_NAMES.index(next(name for name in PIECE_NAMES[6:11] if getattr(state, name))) - 6
+      strong_king, piece_square, weak_king = (state.bk.bit_length()-1) ^ 56, (black.bit_length()-1) ^ 56, (state.wk.bit_length()-1) ^ 56
+    if(piece not in self.tables): return None
+    strong_to_move = (state.turn == state.ai_color) == bool(white) # white on the move is the strong side on the move
+    value = self.read(piece, strong_to_move, strong_king, piece_square, weak_king)
+    if(value == 0): return None
+    if(value == 1): return 0 # draw
+    score = TB_WIN - ply - (value - 2)
+    if(bool(white) == state.ai_color): return score # we're the strong side
+    return -score
+
+# raised inside the search when the time budget runs out
+class Search_Timeout(Exception):
+  pass
+
 # class for storing moves internal to the minmax
-class Move:
+class Move(object):
+  __slots__ = ('tag', 'value')
   def __init__(self, tag, value):
-    self.tag = tag  # string in long-algebraic-notation
+    self.tag = tag  # int move (NO_MOVE if there isn't one), move_to_string gives long-algebraic-notation
     self.value = value  # point value of the move
    
 # function to compute the rank/file of a specific peice on a board    
 # will return the rank/file of all matching items
 def get_rank_file(board): 
+  return [((index >> 3)+1,(index & 7)+1) for index in get_indexes(board)] # return the list
+
+# square numbers of every set bit, lowest first (pulls off the lowest set bit each pass)
+def get_indexes(board):
   search_result = [] # output list
-  for i in range(0,64): # search each bit
-    if((1 << i) & board): search_result.append(i) # store found pieces
-  
-  # lambda to turn index into rank/file
-  resolve = lambda x: ((x >> 3)+1,(x%8)+1)
-  return map(resolve, search_result) # return the list
+  while(board):
+    square = board & -board
+    search_result.append(square.bit_length() - 1)
+    board ^= square
+  return search_result
 
 def get_square(rank_file):
   val = 1 << ((rank_file[0]-1) << 3)  # increment rank (rf[0]<<3 = rf[0]*8)
@@ -0,0 +1,241 @@
+# Benchmarks for the chess ai, run from this folder:
+#   python chess_bench.py eval      (evaluations per second, old bin().count vs running totals, full evaluation
+#                                    one at a time vs NumPy batches)
+#   python chess_bench.py smp       (time to depth for 1/2/4/8 workers, root splitting vs lazy smp)
+#   python chess_bench.py perft     (legal move tree counts against the known values, and nodes/sec)
+#   python chess_bench.py search    (get_chess_move over BENCH_FENS at a fixed depth, --json to save the run)
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import chess_ai
+import chess_ai_defs as ai
+
+START_FEN = 'RNBQKBNR/PPPPPPPP/8/8/8/8/pppppppp/rnbqkbnr w KQkq -'
+
+# fixed positions for the search benchmarks (standard FEN, rank 8 first, see flip_fen)
+BENCH_FENS = [
+  'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq -',                 # start
+  'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq -',     # kiwipete
+  'r1bqkb1r/pppp1ppp/2n2n2/4p3/2B1P3/5N2/PPPP1PPP/RNBQK2R w KQkq -',      # two knights
+  'r2q1rk1/pp2bppp/2n1bn2/3p4/3P4/2NBBN2/PP3PPP/R2Q1RK1 w - -',           # quiet middlegame
+  '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - -',                                # rook endgame
+]
+
+# perft positions (standard FEN) with the known leaf counts for depth 1, 2, 3...
+PERFT_POSITIONS = [
+  ('rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq -', (20, 400, 8902, 197281, 4865609)),
+  ('r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq -', (48, 2039, 97862, 4085603)),
+  ('8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - -', (14, 191, 2812, 43238, 674624)),
+  ('r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq -', (6, 264, 9467, 422333)),
+  ('rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ -', (44, 1486, 62379, 2103487)),
+  ('r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - -', (46, 2079, 89890, 3894594)),
+]
+
+# standard FEN lists rank 8 first, the ai reads rank 1 first, so reverse the ranks
+def flip_fen(fen):
+  fields = fen.split(' ')
+  fields[0] = '/'.join(reversed(fields[0].split('/')))
+  return ' '.join(fields)
+
+# play random games from the start to get a spread of positions (same seed = same positions)
+def random_positions(count, seed = 2015):
+  rand = random.Random(seed)
+  positions = []
+  while(len(positions) < count):
+    state = ai.Board_State(START_FEN, rand.random() < 0.5)
+    for ply in range(rand.randrange(4, 80)):
+      moves = chess_ai.get_legal_moves(state)
+      if(not moves): break
+      state.make_move(rand.choice(moves))
+    snapshot = ai.Board_State()
+    snapshot.copy_board(state)
+    positions.append(snapshot)
+  return positions
+
+# the evaluation as it was before the board kept material totals, counts every bitboard each call
+def legacy_evaluation(state):
+  score = 0 # position is initially neutral
+  score += bin(state.wp).count("1")*100  # count the 1's in the bitmap
+  score -= bin(state.bp).count("1")*100  # subtract black pawns (value 100)
+  score += bin(state.wr).count("1")*525  # white rooks (value 525)
+  score -= bin(state.br).count("1")*525  # black rooks (value 525)
+  score += bin(state.wn).count("1")*350  # white knights (350)
+  score -= bin(state.bn).count("1")*350  # black knights (350)
+  score += bin(state.wb).count("1")*350  # white bishop (350)
+  score -= bin(state.bb).count("1")*350  # black bishop (350)
+  score += bin(state.wq).count("1")*1000 # white queen (1000)
+  score -= bin(state.bq).count("1")*1000 # black queen (1000)
+  if(state.wk != 0): score += 100000 # white king (100,000)
+  if(state.bk != 0): score -= 100000 # black king (100,000)
+  if(not state.ai_color):
+   score = -score # adjust to player color
+  score -= bin(state.get_all_pieces()).count('1') * 25
+  return score
+
+# time an evaluation function over the positions, returns evaluations per second
+def time_evaluation(evaluate, positions, rounds):
+  start = time.time()
+  for i in range(rounds):
+    for state in positions:
+      evaluate(state)
+  return rounds * len(positions) / (time.time() - start)
+
+# time a popcount function over a list of bitboards, returns counts per second
+def time_popcount(popcount, boards):
+  start = time.time()
+  for board in boards: popcount(board)
+  return len(boards) / (time.time() - start)
+
+# evaluations per second before and after the running material totals
+def bench_eval(positions = 500, rounds = 200):
+  states = random_positions(positions)
+  for state in states: # both have to agree before the numbers mean anything
+    assert legacy_evaluation(state) == chess_ai.get_state_evaluation(state)
+  before = time_evaluation(legacy_evaluation, states, rounds)
+  after = time_evaluation(chess_ai.get_state_evaluation, states, rounds)
+  print('positions: %d x %d rounds' % (positions, rounds))
+  print('bin().count evaluation: %10.0f evals/sec' % before)
+  print('running totals:         %10.0f evals/sec (%.1fx)' % (after, after / before))
+
+  # the popcount helper against bin().count on the full occupancy (both as function calls)
+  boards = [state.get_all_pieces() for state in states] * rounds
+  before = time_popcount(lambda board: bin(board).count("1"), boards)
+  after = time_popcount(ai.popcount, boards)
+  print('bin().count popcount:   %10.0f /sec' % before)
+  print('ai.popcount:            %10.0f /sec (%.1fx)' % (after, after / before))
+
+  # the full evaluation (mobility, piece squares) one position at a time against evaluate_batch
+  chess_ai.FULL_EVAL = True
+  for state in states:
+    assert chess_ai.get_state_evaluation(state) == chess_ai.evaluate_batch(chess_ai.pack_boards([state]), state.ai_color)[0]
+  rounds = max(rounds // 10, 1) # the full evaluation is a lot slower
+  before = time_evaluation(chess_ai.get_state_evaluation, states, rounds)
+  chess_ai.FULL_EVAL = False
+  start = time.time()
+  for i in range(rounds):
+    boards = chess_ai.pack_boards(states)
+    chess_ai.evaluate_batch(boards, True)
+  after = rounds * len(states) / (time.time() - start)
+  print('full evaluation:        %10.0f evals/sec' % before)
+  print('evaluate_batch:         %10.0f evals/sec (%.1fx)' % (after, after / before))
+
+# time to a fixed depth over BENCH_FENS for each worker count, root splitting and lazy smp
+# speedup is against one worker in the same mode (both play every position as white)
+def bench_smp(depth = 5, workers = (1, 2, 4, 8), modes = ('root', 'lazy')):
+  print('depth %d, %d positions' % (depth, len(BENCH_FENS)))
+  for mode in modes:
+    base = None
+    for count in workers:
+      chess_ai.set_meta_vals(depth, count, smp = mode) # restarts the pool when anything changed
+      chess_ai.get_pool() # start the processes before the clock does
+      nodes = 0
+      start = time.time()
+      for fen in BENCH_FENS:
+        nodes += chess_ai.get_chess_move(flip_fen(fen), True)['nodes']
+      elapsed = time.time() - start
+      if(base is None): base = elapsed
+      print('%-4s %d workers: %7.2f sec %9d nodes %8.0f nps  speedup %.2fx' % 
+        (mode, count, elapsed, nodes, nodes / elapsed, base / elapsed))
+  chess_ai.close_pool()
+
+# leaf nodes of the legal move tree to depth
+def perft(state, depth):
+  moves = chess_ai.get_legal_moves(state)
+  if(depth == 1): return len(moves)
+  count = 0
+  for move in moves:
+    undo = state.make_move(move)
+    count += perft(state, depth - 1)
+    state.unmake_move(undo)
+  return count
+
+# perft every position up to max_depth (or as deep as its known counts go), returns True if all matched
+def bench_perft(max_depth = 3):
+  passed = True
+  total_nodes = 0
+  total_time = 0
+  for fen, known in PERFT_POSITIONS:
+    print(fen)
+    for depth in range(1, min(max_depth, len(known)) + 1):
+      state = ai.Board_State(flip_fen(fen), True)
+      start = time.time()
+      count = perft(state, depth)
+      elapsed = time.time() - start
+      total_nodes += count
+      total_time += elapsed
+      result = 'ok' if count == known[depth-1] else 'FAIL (expected %d)' % known[depth-1]
+      passed = passed and count == known[depth-1]
+      print('  depth %d: %10d nodes %7.2f sec %9.0f nodes/sec  %s' % (depth, count, elapsed, count / max(elapsed, 1e-6), result))
+  print('%s, %d nodes, %.0f nodes/sec' % ('all passed' if passed else 'FAILED', total_nodes, total_nodes / max(total_time, 1e-6)))
+  return passed
+
+# get_chess_move on every BENCH_FENS position at a fixed depth, returns the run as a dictionary
+# random is seeded per position so equal moves break the same way every run
+# reference is an earlier run's dictionary, the best moves are compared against it
+def bench_search(depth = 4, threads = 1, smp = 'root', reference = None):
+  chess_ai.set_meta_vals(depth, threads, smp = smp, book_file = False) # search every position, no book moves
+  chess_ai.get_pool() # start the processes before the clock does
+  run = {'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(), 'depth': depth, 
+    'threads': threads, 'smp': smp, 'positions': []}
+  for fen in BENCH_FENS:
+    random.seed(2015)
+    result = chess_ai.get_chess_move(flip_fen(fen), fen.split(' ')[1] == 'w')
+    run['positions'].append({'fen': fen, 'move': result['move'], 'value': result['value'], 'time': result['time'],
+      'nodes': result['nodes'], 'nps': result['nps'], 'depth': result['depth']})
+  chess_ai.close_pool()
+  run['time'] = sum(position['time'] for position in run['positions'])
+  run['nodes'] = sum(position['nodes'] for position in run['positions'])
+  run['nps'] = run['nodes'] / max(run['time'], 1e-6)
+  if(reference is not None):
+    moves = dict((position['fen'], position['move']) for position in reference['positions'])
+    compared = [position for position in run['positions'] if position['fen'] in moves]
+    run['agreement'] = sum(1 for position in compared if moves[position['fen']] == position['move'])
+    run['compared'] = len(compared)
+  return run
+
+# human readable version of a bench_search run
+def print_search(run):
+  print('depth %d, %d threads (%s)' % (run['depth'], run['threads'], run['smp']))
+  for position in run['positions']:
+    print('%-70s %-10s %7.2f sec %9d nodes %8.0f nps' % 
+      (position['fen'], position['move'], position['time'], position['nodes'], position['nps']))
+  print('total %.2f sec, %d nodes, %.0f nps' % (run['time'], run['nodes'], run['nps']))
+  if('agreement' in run): print('best move agrees with the reference on %d of %d' % (run['agreement'], run['compared']))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description = 'chess ai benchmarks')
+  subparsers = parser.add_subparsers(dest = 'bench')
+  eval_parser = subparsers.add_parser('eval', help = 'evaluations per second')
+  eval_parser.add_argument('--positions', type = int, default = 500)
+  eval_parser.add_argument('--rounds', type = int, default = 200)
+  smp_parser = subparsers.add_parser('smp', help = 'parallel search scaling')
+  smp_parser.add_argument('--depth', type = int, default = 5)
+  smp_parser.add_argument('--workers', type = int, nargs = '+', default = [1, 2, 4, 8])
+  smp_parser.add_argument('--modes', nargs = '+', choices = ['root', 'lazy'], default = ['root', 'lazy'])
+  perft_parser = subparsers.add_parser('perft', help = 'move generator node counts and speed')
+  perft_parser.add_argument('--depth', type = int, default = 3)
+  search_parser = subparsers.add_parser('search', help = 'fixed depth search over a position suite')
+  search_parser.add_argument('--depth', type = int, default = 4)
+  search_parser.add_argument('--threads', type = int, default = 1)
+  search_parser.add_argument('--smp', choices = ['root', 'lazy'], default = 'root')
+  search_parser.add_argument('--json', help = 'write the run to this file (- for stdout)')
+  search_parser.add_argument('--reference', help = 'earlier --json run to compare best moves against')
+  args = parser.parse_args()
+  if(args.bench == 'eval'):
+    bench_eval(args.positions, args.rounds)
+  elif(args.bench == 'smp'):
+    bench_smp(args.depth, args.workers, args.modes)
+  elif(args.bench == 'perft'):
+    sys.exit(0 if bench_perft(args.depth) else 1)
+  elif(args.bench == 'search'):
+    reference = None
+    if(args.reference): reference = json.load(open(args.reference))
+    run = bench_search(args.depth, args.threads, args.smp, reference)
+    if(args.json == '-'): 
+      json.dump(run, sys.stdout, indent = 2)
+    else:
+      print_search(run)
+      if(args.json): json.dump(run, open(args.json, 'w'), indent = 2)
@@ -0,0 +1,128 @@
+# Opening book builder for the chess ai, run from this folder:
+#   python chess_book.py build openings.txt book.bin   (compile a move-list text file or a .pgn into a book)
+#   python chess_book.py probe book.bin                (list the book moves for a position, start by default)
+# move-list files are one line of play per line, in SAN ("1. e4 e5 2. Nf3") or the ai's notation ("e2-e4 e7-e5"),
+#   anything after a '#' is ignored
+# pgn files can hold any number of games, tags, comments, variations and results are skipped
+import argparse
+import re
+import chess_ai
+import chess_ai_defs as ai
+
+START_FEN = 'RNBQKBNR/PPPPPPPP/8/8/8/8/pppppppp/rnbqkbnr w KQkq -'
+MAX_WEIGHT = 0xFFFF # weights are stored in 16 bits
+
+SAN_MOVE = re.compile(r'^([NBRQK])?([a-h])?([1-8])?x?([a-h][1-8])(?:=?([NBRQ]))?$')
+LONG_MOVE = re.compile(r'^[NBRQK]?[a-h][1-8][-x][a-h][1-8](=[NBRQ])?$')
+MOVE_NUMBER = re.compile(r'^\d+\.+')
+RESULTS = ('1-0', '0-1', '1/2-1/2', '*')
+
+# turn one SAN (or long algebraic) move into an int move for the position, NO_MOVE if it doesn't fit
+def parse_san(state, text):
+  text = text.rstrip('+#!?')
+  if(text.startswith('0-0')): text = text.replace('0', 'O')
+  if(text.startswith('O-O') or LONG_MOVE.match(text)):
+    move = state.parse_move(text)
+    if(move in chess_ai.get_legal_moves(state)): return move
+    return ai.NO_MOVE
+  match = SAN_MOVE.match(text)
+  if(match is None): return ai.NO_MOVE
+  letter, from_file, from_rank, target, promotion = match.groups()
+  piece = ai.PIECE_LETTERS.index(letter or 'P')
+  to_index = ai.SQUARE_NAMES.index(target)
+  candidates = []
+  for move in chess_ai.get_legal_moves(state): # SAN only disambiguates between legal moves
+    from_name = ai.SQUARE_NAMES[move & 63]
+    if(((move >> 6) & 63) != to_index or ((move >> 12) & 15) % 6 != piece): continue
+    if(from_file and from_name[0] != from_file): continue
+    if(from_rank and from_name[1] != from_rank): continue
+    flags = move >> 20
+    if(flags & ai.MOVE_PROMOTION and ai.PIECE_LETTERS[ai.PROMOTION_PIECES[flags & 3]] != (promotion or 'Q')): continue
+    candidates.append(move)
+  if(len(candidates) != 1): return ai.NO_MOVE
+  return candidates[0]
+
+# split a move-list text file into games (lists of move tokens)
+def read_move_lists(text):
+  games = []
+  for line in text.splitlines():
+    tokens = line.split('#')[0].split()
+    if(tokens): games.append(tokens)
+  return games
+
+# split a pgn file into games (lists of move tokens)
+def read_pgn(text):
+  games = []
+  tokens = []
+  text = re.sub(r'\{[^}]*\}|;[^\n]*', ' ', text) # comments
+  while(re.search(r'\([^()]*\)', text)): text = re.sub(r'\([^()]*\)', ' ', text) # variations, innermost first
+  for line in text.splitlines():
+    if(line.startswith('[')): # tag section, starts the next game
+      if(tokens): games.append(tokens)
+      tokens = []
+      continue
+    tokens += [token for token in line.split() if not token.startswith('$')] # numeric annotations
+  if(tokens): games.append(tokens)
+  return games
+
+# play a game's tokens from the start, returns [(book key, move)] for the first max_plies plies
+def play_game(tokens, max_plies):
+  state = ai.Board_State(START_FEN, True)
+  positions = []
+  for token in tokens:
+    if(len(positions) >= max_plies or token in RESULTS): break
+    token = MOVE_NUMBER.sub('', token) # "1.e4" and "1." both lose the number
+    if(not token): continue
+    move = parse_san(state, token)
+    if(move == ai.NO_MOVE):
+      print('  stopped at unreadable move %s' % token)
+      break
+    positions.append((ai.get_book_key(state), move))
+    state.make_move(move)
+  return positions
+
+# count how often each move was played from each position and write the sorted records
+def build_book(source, destination, max_plies = 20, min_weight = 1, source_format = None):
+  text = open(source).read()
+  if(source_format is None):
+    if(source.lower().endswith('.pgn')): source_format = 'pgn'
+    else: source_format = 'moves'
+  if(source_format == 'pgn'): games = read_pgn(text)
+  else: games = read_move_lists(text)
+  weights = {}
+  for game in games:
+    for entry in play_game(game, max_plies):
+      weights[entry] = weights.get(entry, 0) + 1
+  records = [(key, move, min(weight, MAX_WEIGHT)) for (key, move), weight in weights.items() if weight >= min_weight]
+  records.sort(key = lambda record: (record[0], -record[2], record[1])) # by key, most played first
+  output = open(destination, 'wb')
+  for record in records: output.write(ai.BOOK_RECORD.pack(*record))
+  output.close()
+  print('%d games, %d positions, %d moves written to %s' %
+    (len(games), len(set(record[0] for record in records)), len(records), destination))
+
+# print the book moves for one position
+def probe_book(path, fen, color):
+  book = ai.Opening_Book(path)
+  state = ai.Board_State(fen, color)
+  for move, weight in book.get_moves(state):
+    print('%-10s %d' % (ai.move_to_string(move), weight))
+  book.close()
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description = 'chess ai opening book')
+  subparsers = parser.add_subparsers(dest = 'command')
+  build_parser = subparsers.add_parser('build', help = 'compile a book from a pgn or move-list file')
+  build_parser.add_argument('source')
+  build_parser.add_argument('destination')
+  build_parser.add_argument('--plies', type = int, default = 20, help = 'how deep into each game to record')
+  build_parser.add_argument('--min-weight', type = int, default = 1, help = 'drop moves played fewer times')
+  build_parser.add_argument('--format', choices = ['pgn', 'moves'], help = 'default from the file extension')
+  probe_parser = subparsers.add_parser('probe', help = 'list the book moves for a position')
+  probe_parser.add_argument('book')
+  probe_parser.add_argument('fen', nargs = '?', default = START_FEN, help = "the ai's FEN (rank 1 first)")
+  args = parser.parse_args()
+  if(args.command == 'build'):
+    build_book(args.source, args.destination, args.plies, args.min_weight, args.format)
+  elif(args.command == 'probe'):
+    probe_book(args.book, args.fen, True)
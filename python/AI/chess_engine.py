@@ -0,0 +1,204 @@
+# Chess engine daemon: one long-running chess ai (worker pool, transposition tables, opening book all stay
+#   warm) shared by any number of clients over a unix socket, run from this folder:
+#   python chess_engine.py serve                  (start the engine, --socket, --depth, --threads, --ponder)
+#   python chess_engine.py move FEN               (ask a running engine for a move, --time in milliseconds)
+# clients speak a UCI-like line protocol, one command per line:
+#   uci                              -> id and option lines, then uciok
+#   isready                          -> readyok
+#   setoption name Depth value 6     -> nothing back, options are the set_meta_vals ones (see OPTIONS), they
+#                                       change the engine for every client
+#   position fen FEN                 -> nothing back, the ai's FEN (rank 1 first), the ai plays the side on the move
+#   go [movetime MS]                 -> info depth D score cp V nodes N time MS nps X, then bestmove MOVE
+#                                       (long algebraic like get_chess_move, 0000 when there's no legal move)
+#   stop                             -> stops pondering
+#   quit                             -> closes the connection, the engine keeps running
+# anything it can't follow gets "info string error ..." back
+# searches from different clients take turns (get_chess_move holds chess_ai.engine_lock)
+import argparse
+import os
+import socket
+import time
+try:
+  import socketserver # python 3
+except ImportError:
+  import SocketServer as socketserver
+import chess_ai
+
+SOCKET_PATH = '/tmp/chess_ai.sock'
+ENGINE_NAME = 'ieee2015 chess ai'
+
+# true/false option values
+def parse_bool(value):
+  return value.lower() in ('true', 'on', '1', 'yes')
+
+# book option, a path or false for no book
+def parse_book(value):
+  if(value.lower() in ('false', 'none', 'off', '')): return False
+  return value
+
+# setoption names (lower case, spaces dropped) to the set_meta_vals argument and how to read the value
+OPTIONS = {
+  'depth': ('depth', int),
+  'threads': ('threads', int),
+  'hash': ('hash_mb', int),
+  'qdepth': ('qdepth', int),
+  'smp': ('smp', str),
+  'book': ('book_file', parse_book),
+  'aspiration': ('aspiration', int),
+  'nullmove': ('null_move', int),
+  'lmr': ('lmr', int),
+  'ponder': ('ponder', parse_bool),
+  'fulleval': ('full_eval', parse_bool),
+  'batcheval': ('batch_eval', parse_bool),
+}
+
+# change one engine setting by its setoption name
+def set_option(name, value):
+  key = name.lower().replace(' ', '')
+  if(key not in OPTIONS): raise ValueError('unknown option ' + name)
+  argument, convert = OPTIONS[key]
+  settings = {'depth': chess_ai.MAX_DEPTH, 'threads': chess_ai.MAX_THREADS}
+  settings[argument] = convert(value)
+  with chess_ai.engine_lock: # don't pull the pool out from under someone else's search
+    chess_ai.set_meta_vals(**settings)
+
+# search a position for the side on the move, time_budget in milliseconds (None for no limit)
+# returns {move, check, score, depth, nodes, time} (time in milliseconds, move '' if there's no legal move)
+def get_move(fen, time_budget = None):
+  fields = fen.split()
+  color = (len(fields) < 2 or fields[1] == 'w') # the ai is whoever is on the move
+  result = chess_ai.get_chess_move(fen, color, time_budget)
+  return {'move': result['move'], 'check': result['check'], 'score': result['value'], 'depth': result['depth'],
+    'nodes': result['nodes'], 'time': int(result['time'] * 1000)}
+
+# one client's conversation with the engine, remembers its position between commands
+class Engine_Session:
+  def __init__(self):
+    self.fen = None
+
+  # run one command line, returns the lines to send back
+  def handle_line(self, line):
+    words = line.split()
+    if(not words): return []
+    command = words[0]
+    if(command == 'uci'):
+      return ['id name ' + ENGINE_NAME] + ['option name %s' % name for name in sorted(OPTIONS)] + ['uciok']
+    if(command == 'isready'): return ['readyok']
+    if(command == 'setoption'): # setoption name NAME value VALUE
+      if('name' not in words or 'value' not in words): raise ValueError('setoption needs a name and a value')
+      name = ' '.join(words[words.index('name') + 1:words.index('value')])
+      set_option(name, ' '.join(words[words.index('value') + 1:]))
+      return []
+    if(command == 'position'): # position fen FEN
+      if(len(words) < 3 or words[1] != 'fen'): raise ValueError('position needs fen and a FEN')
+      self.fen = ' '.join(words[2:])
+      return []
+    if(command == 'go'): # go [movetime MS]
+      if(self.fen is None): raise ValueError('no position set')
+      time_budget = None
+      if('movetime' in words): time_budget = int(words[words.index('movetime') + 1])
+      result = get_move(self.fen, time_budget)
+      info = 'info depth %d score cp %d nodes %d time %d nps %d' % (result['depth'], result['score'],
+        result['nodes'], result['time'], result['nodes'] * 1000 // max(result['time'], 1))
+      return [info, 'bestmove ' + (result['move'] or '0000')]
+    if(command == 'stop'):
+      chess_ai.stop_ponder()
+      return []
+    raise ValueError('unknown command ' + command)
+
+# serves one connection, each client gets its own thread (ThreadingMixIn)
+class Engine_Handler(socketserver.StreamRequestHandler):
+  def handle(self):
+    session = Engine_Session()
+    while(True):
+      line = self.rfile.readline()
+      if(not line): break # client hung up
+      line = line.decode('ascii', 'replace').strip()
+      if(line == 'quit'): break
+      try:
+        replies = session.handle_line(line)
+      except Exception as error: # bad input shouldn't take the engine down, tell the client and carry on
+        replies = ['info string error %s' % error]
+      for reply in replies: self.wfile.write((reply + '\n').encode('ascii'))
+      self.wfile.flush()
+
+class Engine_Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  daemon_threads = True # don't wait on connected clients at shutdown
+
+# listen on the socket until interrupted (a leftover socket file from an old engine is replaced)
+def serve(path = SOCKET_PATH):
+  if(os.path.exists(path)): os.remove(path)
+  server = Engine_Server(path, Engine_Handler)
+  print('chess engine listening on %s' % path)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    os.remove(path)
+    chess_ai.close_pool()
+
+# client side of the protocol, for scripts and nodes that don't want to speak it themselves
+class Engine_Client:
+  def __init__(self, path = SOCKET_PATH):
+    self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.connection.connect(path)
+    self.lines = self.connection.makefile('rb')
+
+  # send one command, read replies up to (and including) the one starting with until (None to not wait)
+  def command(self, line, until = None):
+    self.connection.sendall((line + '\n').encode('ascii'))
+    replies = []
+    while(until is not None):
+      reply = self.lines.readline().decode('ascii').strip()
+      if(not reply): raise IOError('engine closed the connection')
+      replies.append(reply)
+      if(reply.startswith(until) or reply.startswith('info string error')): break
+    return replies
+
+  def set_option(self, name, value):
+    self.command('setoption name %s value %s' % (name, value))
+
+  # same as get_move, but on the engine (time is the engine's search time, in milliseconds)
+  def get_move(self, fen, time_budget = None):
+    go = 'go' if time_budget is None else 'go movetime %d' % time_budget
+    self.command('position fen ' + fen)
+    replies = self.command(go, 'bestmove')
+    if(replies[-1].startswith('info string error')): raise ValueError(replies[-1][len('info string error '):])
+    result = {'move': replies[-1].split()[1]}
+    if(result['move'] == '0000'): result['move'] = ''
+    for reply in replies:
+      words = reply.split()
+      if(words[0] != 'info' or 'depth' not in words): continue
+      for name in ('depth', 'nodes', 'time'): result[name] = int(words[words.index(name) + 1])
+      result['score'] = int(words[words.index('cp') + 1])
+    return result
+
+  def close(self):
+    self.connection.sendall(b'quit\n')
+    self.connection.close()
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description = 'chess ai engine daemon')
+  subparsers = parser.add_subparsers(dest = 'command')
+  serve_parser = subparsers.add_parser('serve', help = 'run the engine')
+  serve_parser.add_argument('--socket', default = SOCKET_PATH)
+  serve_parser.add_argument('--depth', type = int, default = chess_ai.MAX_DEPTH)
+  serve_parser.add_argument('--threads', type = int, default = chess_ai.MAX_THREADS)
+  serve_parser.add_argument('--ponder', action = 'store_true', help = 'search on the opponent\'s time')
+  move_parser = subparsers.add_parser('move', help = 'ask a running engine for a move')
+  move_parser.add_argument('fen', help = "the ai's FEN (rank 1 first)")
+  move_parser.add_argument('--socket', default = SOCKET_PATH)
+  move_parser.add_argument('--time', type = int, help = 'milliseconds the search may take')
+  args = parser.parse_args()
+  if(args.command == 'serve'):
+    chess_ai.set_meta_vals(args.depth, args.threads, ponder = args.ponder)
+    serve(args.socket)
+  elif(args.command == 'move'):
+    start = time.time()
+    client = Engine_Client(args.socket)
+    result = client.get_move(args.fen, args.time)
+    client.close()
+    print('%s (score %d, depth %d, %d nodes, %d ms searching, %d ms round trip)' % (result['move'] or 'no move',
+      result['score'], result['depth'], result['nodes'], result['time'], (time.time() - start) * 1000))
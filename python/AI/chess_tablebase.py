@@ -0,0 +1,170 @@
+# Endgame tablebase generator for the chess ai, run from this folder:
+#   python chess_tablebase.py build          (writes kqk.tb, krk.tb and kpk.tb into tablebases/)
+#   python chess_tablebase.py probe FEN      (looks a position up in the built tables, the ai's FEN)
+# retrograde analysis: start from the mates, walk the moves backwards one ply at a time
+#   a strong side position wins as soon as one of its moves reaches a lost position (first found = fastest)
+#   a weak side position is lost once every one of its moves reaches a won position (last found = slowest)
+# everything is worked out over the full board with the strong side as white, then packed with the
+#   symmetries in get_tablebase_index
+import argparse
+import os
+import time
+import chess_ai_defs as ai
+
+TABLEBASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tablebases')
+UNKNOWN = -1
+
+# position number in the full working tables
+def full_index(strong_to_move, strong_king, piece, weak_king):
+  return ((0 if strong_to_move else 1) << 18) | (strong_king << 12) | (piece << 6) | weak_king
+
+# squares the strong piece attacks
+def piece_attacks(piece, square, occupied):
+  if(piece == 4): return ai.rook_attacks(square, occupied) | ai.bishop_attacks(square, occupied)
+  if(piece == 1): return ai.rook_attacks(square, occupied)
+  return ai.PAWN_ATTACKS[0][square]
+
+# can the position come up in a game (with the side to move as given)
+def is_legal(piece, strong_to_move, strong_king, square, weak_king):
+  if(strong_king == square or strong_king == weak_king or square == weak_king): return False
+  if(ai.KING_ATTACKS[strong_king] & (1 << weak_king)): return False
+  if(piece == 0 and (square < 8 or square >= 56)): return False # pawns never stand on the end ranks
+  if(strong_to_move): # the weak king can't be left in check
+    return not (piece_attacks(piece, square, (1 << strong_king) | (1 << square)) >> weak_king) & 1
+  return True
+
+# work out plies to mate for every position, returns the full table (UNKNOWN for draws and illegal positions)
+#   and the legal flags, promotions look their result up in the finished queen and rook tables
+def solve(piece, promotions = None):
+  size = 1 << 19
+  legal = [False] * size
+  plies = [UNKNOWN] * size
+  moves_left = [0] * size # weak side moves not yet known to lose
+  buckets = {} # plies to mate -> positions found at that distance
+  for strong_king in range(64):
+    for square in range(64):
+      for weak_king in range(64):
+        if(is_legal(piece, True, strong_king, square, weak_king)):
+          legal[full_index(True, strong_king, square, weak_king)] = True
+        if(not is_legal(piece, False, strong_king, square, weak_king)): continue
+        index = full_index(False, strong_king, square, weak_king)
+        legal[index] = True
+        # count the weak king's moves, attacks are worked out with it off the board so it can't hide behind itself
+        occupied = (1 << strong_king) | (1 << square)
+        attacked = ai.KING_ATTACKS[strong_king] | piece_attacks(piece, square, occupied)
+        count = 0
+        for target in ai.get_indexes(ai.KING_ATTACKS[weak_king] & ~(1 << strong_king)):
+          if(target == square): # taking the piece, legal if the king doesn't guard it, always a draw
+            if(not (ai.KING_ATTACKS[strong_king] >> target) & 1): count += 1
+          elif(not (attacked >> target) & 1): count += 1
+        moves_left[index] = count
+        if(count == 0 and (attacked >> weak_king) & 1): # checkmate
+          plies[index] = 0
+          buckets.setdefault(0, []).append(index)
+
+  if(promotions): # pawn on the 7th steps up, the result is whatever the new queen or rook ending says
+    for strong_king in range(64):
+      for square in range(48, 56):
+        for weak_king in range(64):
+          index = full_index(True, strong_king, square, weak_king)
+          if(not legal[index] or square + 8 in (strong_king, weak_king)): continue
+          for table in promotions:
+            result = table[full_index(False, strong_king, square + 8, weak_king)]
+            if(result != UNKNOWN and (plies[index] == UNKNOWN or result + 1 < plies[index])):
+              plies[index] = result + 1
+              buckets.setdefault(result + 1, []).append(index)
+
+  distance = 0
+  while(buckets):
+    for index in buckets.pop(distance, []):
+      if(plies[index] != distance): continue # a faster mate was found after this was queued
+      strong_to_move = not (index >> 18)
+      strong_king, square, weak_king = (index >> 12) & 63, (index >> 6) & 63, index & 63
+      occupied = (1 << strong_king) | (1 << square) | (1 << weak_king)
+      if(strong_to_move): # won, the weak side could have walked into it
+        for before in ai.get_indexes(ai.KING_ATTACKS[weak_king] & ~occupied):
+          previous = full_index(False, strong_king, square, before)
+          if(not legal[previous] or plies[previous] != UNKNOWN): continue
+          moves_left[previous] -= 1
+          if(moves_left[previous] == 0): # every move loses, this was the slowest
+            plies[previous] = distance + 1
+            buckets.setdefault(distance + 1, []).append(previous)
+      else: # lost, any strong side move into it wins
+        previous_positions = [full_index(True, before, square, weak_king)
+          for before in ai.get_indexes(ai.KING_ATTACKS[strong_king] & ~occupied)]
+        if(piece): # sliders move the same both ways
+          sources = piece_attacks(piece, square, occupied) & ~occupied
+        else: # pawns step back down, two squares from the 4th rank
+          sources = 0
+          if(square >= 16 and not (occupied >> (square - 8)) & 1):
+            sources = 1 << (square - 8)
+            if(square >> 3 == 3 and not (occupied >> (square - 16)) & 1): sources |= 1 << (square - 16)
+        previous_positions += [full_index(True, strong_king, before, weak_king) for before in ai.get_indexes(sources)]
+        for previous in previous_positions:
+          if(legal[previous] and (plies[previous] == UNKNOWN or plies[previous] > distance + 1)):
+            plies[previous] = distance + 1
+            buckets.setdefault(distance + 1, []).append(previous)
+    distance += 1
+  return (plies, legal)
+
+# pack the full table into the symmetric layout and write it
+def write_table(path, piece, plies, legal):
+  pawns = (piece == 0)
+  values = [0] * ai.get_tablebase_size(pawns)
+  for index in range(1 << 19):
+    if(not legal[index]): continue
+    strong_to_move = not (index >> 18)
+    strong_king, square, weak_king = (index >> 12) & 63, (index >> 6) & 63, index & 63
+    if(plies[index] == UNKNOWN): value = 1 # draw
+    else: value = plies[index] + 2
+    values[ai.get_tablebase_index(pawns, strong_to_move, strong_king, square, weak_king)] = value
+  bits = max(values).bit_length()
+  output = bytearray(ai.TB_HEADER.pack(ai.TB_MAGIC, bits, len(values)))
+  buffer = 0 # bits waiting to be written, lowest first
+  buffered = 0
+  for value in values:
+    buffer |= value << buffered
+    buffered += bits
+    while(buffered >= 8):
+      output.append(buffer & 0xFF)
+      buffer >>= 8
+      buffered -= 8
+  if(buffered): output.append(buffer)
+  open(path, 'wb').write(output)
+  return bits
+
+# generate all three tables (the pawn ending needs the other two for its promotions)
+def build_tables(folder = TABLEBASE_DIR):
+  if(not os.path.isdir(folder)): os.makedirs(folder)
+  solved = {}
+  for name in ('kqk', 'krk', 'kpk'):
+    start = time.time()
+    piece = ai.TB_ENDINGS[name]
+    if(piece == 0): plies, legal = solve(piece, [solved['kqk'], solved['krk']])
+    else: plies, legal = solve(piece)
+    solved[name] = plies
+    bits = write_table(os.path.join(folder, name + '.tb'), piece, plies, legal)
+    print('%s: longest mate %d plies, %d bits per position, %.1f sec' % (name, max(plies), bits, time.time() - start))
+
+# print what the tables say about a position
+def probe_position(fen, folder = TABLEBASE_DIR):
+  state = ai.Board_State(fen, True)
+  score = ai.Endgame_Tablebase(folder).probe(state, 0)
+  if(score is None): print('not in the tables')
+  elif(score == 0): print('draw')
+  elif(score > 0): print('white mates in %d plies' % (ai.TB_WIN - score))
+  else: print('black mates in %d plies' % (ai.TB_WIN + score))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description = 'chess ai endgame tablebases')
+  subparsers = parser.add_subparsers(dest = 'command')
+  build_parser = subparsers.add_parser('build', help = 'generate the tables')
+  build_parser.add_argument('--folder', default = TABLEBASE_DIR)
+  probe_parser = subparsers.add_parser('probe', help = 'look up a position')
+  probe_parser.add_argument('fen', help = "the ai's FEN (rank 1 first)")
+  probe_parser.add_argument('--folder', default = TABLEBASE_DIR)
+  args = parser.parse_args()
+  if(args.command == 'build'):
+    build_tables(args.folder)
+  elif(args.command == 'probe'):
+    probe_position(args.fen, args.folder)
@@ -3,28 +3,27 @@ import cv2
 
 ################ROBOT IS BLUE PLAYER######################
 
+#hsv boundaries of the piece colors
+#estimated values until testing
+LOWER_BLUE = np.array([108, 115, 74], np.uint8)
+UPPER_BLUE = np.array([155, 201, 215], np.uint8)
+LOWER_ORANGE = np.array([0, 100, 148], np.uint8)
+UPPER_ORANGE = np.array([91, 231, 224], np.uint8)
 
-def threshold_for_contours(img_from_array):
+#a square needs at least this many pixels of a color to hold a piece of it
+#(1 is the same as finding any contour at all)
+MIN_PIECE_PIXELS = 1
 
-    hsvimg = cv2.cvtColor(img_from_array, cv2.COLOR_BGR2HSV)
 
-    #print type(hsvimg)
-    lower_blue = np.array([108, 115, 74], np.uint8)
-    #estimated values until testing
-    upper_blue = np.array([155, 201, 215], np.uint8)
-    #estimated values until testing
+def threshold_for_contours(img_from_array):
 
-    #threshold_for_contours boundaries to only get orange colors
-    lower_orange = np.array([0, 100, 148], np.uint8)
-    #estimated values until testing
-    upper_orange = np.array([91, 231, 224], np.uint8)
-    #estimated values until testing
+    hsvimg = cv2.cvtColor(img_from_array, cv2.COLOR_BGR2HSV)
 
     #heres where it is actually threshold_for_contourse
     #using the boundaries to get specified colors
     #print 'Type:', hsvimg.dtype, 'Other bullshit:', hsvimg.shape
-    blue = cv2.inRange(hsvimg, lower_blue, upper_blue)
-    orange = cv2.inRange(hsvimg, lower_orange, upper_orange)
+    blue = cv2.inRange(hsvimg, LOWER_BLUE, UPPER_BLUE)
+    orange = cv2.inRange(hsvimg, LOWER_ORANGE, UPPER_ORANGE)
     #blue and orange are binary threshholded images
     #if the image initially had a blue piece,
     #blue will have values of zero and 1
@@ -131,3 +130,60 @@ def main(array_of_images):
         occupancy_grid.append(square_occupant)
 
     return occupancy_grid, array_of_coordinates
+
+
+#pixel bounds of each square (arrays of tops, bottoms, lefts, rights), clipped to the image
+#the way slicing a crop would be
+def square_bounds(squares, height, width):
+    tops = np.clip([square.topLeft[1] for square in squares], 0, height)
+    bottoms = np.clip([square.bottomRight[1] for square in squares], tops, height)
+    lefts = np.clip([square.topLeft[0] for square in squares], 0, width)
+    rights = np.clip([square.bottomRight[0] for square in squares], lefts, width)
+    return tops, bottoms, lefts, rights
+
+
+#sum of an image inside each square (all channels), for all of them at once
+#the integral image holds the sum of everything above and left of each pixel,
+#so each square's sum is four lookups: bottom right - top right - bottom left + top left
+def sum_in_squares(image, tops, bottoms, lefts, rights):
+    integral = cv2.integral(image)
+    sums = integral[bottoms, rights] - integral[tops, rights] - integral[bottoms, lefts] + integral[tops, lefts]
+    if sums.ndim > 1:
+        sums = sums.sum(axis=1)
+    return sums
+
+
+#pixels of a mask (0 or 255) inside each square
+def count_in_squares(mask, tops, bottoms, lefts, rights):
+    return sum_in_squares(mask, tops, bottoms, lefts, rights) // 255
+
+
+#occupancy of any number of squares in one pass over the image, same answers as main() on their crops
+#one hsv conversion and one pair of color masks for the part of the image the squares cover,
+#then pixel counts per square
+#returns an array with one value per square, 0 is empty, 1 is orange, 2 is blue
+def classify_squares(board_image, tops, bottoms, lefts, rights):
+    #only the part of the image the squares cover, bounds relative to it
+    top, left = tops.min(), lefts.min()
+    board_image = board_image[top:bottoms.max(), left:rights.max()]
+    tops, bottoms, lefts, rights = tops - top, bottoms - top, lefts - left, rights - left
+
+    hsvimg = cv2.cvtColor(board_image, cv2.COLOR_BGR2HSV)
+    blue = cv2.inRange(hsvimg, LOWER_BLUE, UPPER_BLUE)
+    orange = cv2.inRange(hsvimg, LOWER_ORANGE, UPPER_ORANGE)
+
+    has_blue = count_in_squares(blue, tops, bottoms, lefts, rights) >= MIN_PIECE_PIXELS
+    has_orange = count_in_squares(orange, tops, bottoms, lefts, rights) >= MIN_PIECE_PIXELS
+
+    #only one color in the square decides it, both or neither is empty
+    occupancy = np.zeros(len(tops), np.uint8)
+    occupancy[has_blue & ~has_orange] = 2
+    occupancy[has_orange & ~has_blue] = 1
+    return occupancy
+
+
+#occupancy of the whole rectified board in one pass
+#returns an (8, 8) array, row 0 is the top of the image, 0 is empty, 1 is orange, 2 is blue
+def occupancy_from_board(board_image, squares):
+    height, width = board_image.shape[:2]
+    return classify_squares(board_image, *square_bounds(squares, height, width)).reshape(8, 8)
@@ -1,10 +1,16 @@
 import cv2
 
 
+#matrix that rotates an image of this size about its center, keep it to rotate later frames the same way
+def getRotationMatrix(theta, img):
+    rows, cols = img.shape[:2]
+    return cv2.getRotationMatrix2D((cols / 2, rows / 2), theta, 1)
+
+
 #rotates the image at a given angle value
 def rotateImage(theta, img):
     rows, cols, ret = img.shape
-    M = cv2.getRotationMatrix2D((cols / 2, rows / 2), theta, 1)
+    M = getRotationMatrix(theta, img)
     dst = cv2.warpAffine(img, M, (cols, rows))
     print "type is: ", type(dst)
     return dst
@@ -4,10 +4,19 @@ import numpy as np
 picThresh = 126
 lineThresh = 145
 density = 0.1
+#lines closer than this (pixels) are the same line
+sameLine = 20
+#lines each way on a chess board
+gridLines = 9
 
 
+#finds the chess board's grid lines, takes an image or the file name of one
+#returns (horizontal, vertical), each a (9, 2) array of Hough line parameters (rho, theta)
 def addEdges(filename):
-    image = cv2.imread(filename)
+    if isinstance(filename, str):
+        image = cv2.imread(filename)
+    else:
+        image = filename
 
     #Remove edge noise
     image_blurred = cv2.GaussianBlur(image, (3, 3), 0)
@@ -21,8 +30,8 @@ def addEdges(filename):
     grad_y = cv2.Scharr(image_gray, cv2.CV_32F, 0, 1)
 
     #Overall grad, pythagorum
-    grad_x = pow(grad_x, 2, grad_x)
-    grad_y = pow(grad_y, 2, grad_y)
+    grad_x = np.power(grad_x, 2, grad_x)
+    grad_y = np.power(grad_y, 2, grad_y)
 
     grad = grad_x + grad_y
     grad = np.sqrt(grad)
@@ -32,24 +41,52 @@ def addEdges(filename):
     ret, edges_thresholded = cv2.threshold(edges, picThresh, 255, cv2.THRESH_TOZERO)
 
     #Lines
-    edges_color = cv2.cvtColor(edges_thresholded, cv2.COLOR_GRAY2RGB)
-    edges_line = edges_color.copy()
-
     lines = cv2.HoughLines(edges_thresholded, density, np.pi / 180, lineThresh)
-    for rho, theta in lines[0]:
-        if((-.005 < theta and theta < .005) or (1.55 < theta and theta < 1.59)):
-            a = np.cos(theta)
-            b = np.sin(theta)
-
-            x0 = a * rho
-            y0 = b * rho
-
-            x1 = int(x0 + 1000 * (-b))
-            y1 = int(y0 + 1000 * (a))
-
-            x2 = int(x0 - 1000 * (-b))
-            y2 = int(y0 - 1000 * (a))
-
-            cv2.line(edges_line, (x1, y1), (x2, y2), (0, 0, 255), 2)
-
-    return edges_line
+    if lines is None:
+        raise ValueError('no lines found on the chess board')
+    #flattened because opencv 2 and opencv 3+ shape the lines differently
+    lines = lines.reshape(-1, 2)
+    theta = lines[:, 1]
+
+    #theta 0 is a vertical line at x = rho, theta pi/2 a horizontal one at y = rho
+    vertical = lines[(-.005 < theta) & (theta < .005)]
+    horizontal = lines[(1.55 < theta) & (theta < 1.59)]
+    return clusterLines(horizontal), clusterLines(vertical)
+
+
+#Hough finds every line several times over (a few pixels apart), and sometimes lines that aren't on the board
+#1-D binning on rho: sort, start a new bin wherever the gap is over sameLine, each bin becomes one line
+#(its mean rho and theta), then the gridLines bins in a row that are the most evenly spaced are the board
+#returns a (gridLines, 2) array of rho, theta, top to bottom or left to right
+def clusterLines(lines):
+    lines = lines[np.argsort(lines[:, 0])]
+    bins = np.split(lines, np.nonzero(np.diff(lines[:, 0]) > sameLine)[0] + 1)
+    if len(bins) < gridLines:
+        raise ValueError('found %d grid lines on the chess board, need %d' % (len(bins), gridLines))
+    merged = np.array([line_bin.mean(axis=0) for line_bin in bins])
+    spacing = np.diff(merged[:, 0])
+    unevenness = [spacing[i:i + gridLines - 1].std() / spacing[i:i + gridLines - 1].mean()
+                  for i in range(len(merged) - gridLines + 1)]
+    first = int(np.argmin(unevenness))
+    return merged[first:first + gridLines]
+
+
+#draws the (horizontal, vertical) lines from addEdges on a copy of the image, for looking at what it found
+def drawLines(image, lines):
+    image_lines = image.copy()
+    for rho, theta in np.vstack(lines):
+        a = np.cos(theta)
+        b = np.sin(theta)
+
+        x0 = a * rho
+        y0 = b * rho
+
+        x1 = int(x0 + 1000 * (-b))
+        y1 = int(y0 + 1000 * (a))
+
+        x2 = int(x0 - 1000 * (-b))
+        y2 = int(y0 - 1000 * (a))
+
+        cv2.line(image_lines, (x1, y1), (x2, y2), (0, 0, 255), 2)
+
+    return image_lines
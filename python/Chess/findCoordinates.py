@@ -1,42 +1,19 @@
+import numpy as np
 
 
-# removes supurluous points
-def removeExcess(coordinates, newCoordinates):
-    #threshold of 7
-    newCoordinates.append(coordinates[0])
-    r = 0
-    for i in range(0, len(coordinates)):
-        if abs(coordinates[i] - newCoordinates[r]) > 20:
-            newCoordinates.append(coordinates[i])
-            r += 1
+#create an array with (x,y) coordinates for every corner, where each horizontal line crosses each vertical one
+#lines are the (horizontal, vertical) rho, theta arrays from edgechesshc.addEdges
+#each line is x * cos(theta) + y * sin(theta) = rho, so a corner is the solution of two of those,
+#worked out for all of them at once
+#returns a (9, 9, 2) array, [row][column] = (x, y) rounded to pixels, rows top to bottom
+def getCoordinates(lines):
+    horizontal, vertical = lines
+    rho_h, theta_h = horizontal[:, 0, None], horizontal[:, 1, None]
+    rho_v, theta_v = vertical[None, :, 0], vertical[None, :, 1]
 
+    #Cramer's rule
+    determinant = np.cos(theta_v) * np.sin(theta_h) - np.sin(theta_v) * np.cos(theta_h)
+    x = (rho_v * np.sin(theta_h) - rho_h * np.sin(theta_v)) / determinant
+    y = (rho_h * np.cos(theta_v) - rho_v * np.cos(theta_h)) / determinant
 
-def getCoordinates(imageWithStuff):
-
-    img = imageWithStuff
-
-    tempHor = []
-    for i in range(0, len(img)):
-        if img[i][0][0] == 0 and img[i][0][1] == 0 and img[i][0][2] == 255:
-            tempHor.append(i)
-
-    # add verticle lines to an array-- duplicates must also be handled later
-    tempVert = []
-    for i in range(0, len(img[0])):
-        if img[0][i][0] == 0 and img[0][i][1] == 0 and img[0][i][2] == 255:
-            tempVert.append(i)
-
-    # create new arrays without the excess points
-    horizontal = []
-    verticle = []
-
-    removeExcess(tempHor, horizontal)
-    removeExcess(tempVert, verticle)
-
-    #create an array with (x,y) coordinates for every corner
-    coordinates = []
-    for j in range(0, len(horizontal)):
-        for i in range(0, len(verticle)):
-            coordinates.append([verticle[i], horizontal[j]])
-
-    return coordinates
+    return np.rint(np.dstack((x, y))).astype(int)
@@ -68,14 +68,15 @@ def main():
     cv2.imwrite('lib/rotated.jpg', rotatedImage)
 
     #Find all the lines of the squares
-    imgWithEdges = edgechesshc.addEdges('lib/rotated.jpg')
+    lines = edgechesshc.addEdges('lib/rotated.jpg')
+    imgWithEdges = edgechesshc.drawLines(rotatedImage, lines)
 
     #Get all the coordinates of the keypoints
-    coordinates = findCoordinates.getCoordinates(imgWithEdges)
+    coordinates = findCoordinates.getCoordinates(lines)
 
     #Pass coordinates on to Squares
 
-    squares = Squares.populateSquares(coordinates)
+    squares = Squares.populateSquares(coordinates.reshape(-1, 2))
 
     #Load squares with their starting state
     Squares.loadPieces(squares, new_piece_attribute, pieceTypeArray)
@@ -7,6 +7,7 @@ from catkin_pkg.python_setup import generate_distutils_setup
 setup_args = generate_distutils_setup(
     packages=['chess_ai'],
     package_dir={'': 'src'},
+    package_data={'chess_ai': ['book.bin', 'tablebases/*.tb']},
 )
 
 setup(**setup_args)
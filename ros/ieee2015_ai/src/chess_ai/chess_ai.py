@@ -1,360 +1,1137 @@
 import numpy as np
 import chess_ai_defs as ai
 import time
-from random import randrange
-from multiprocessing import Pool
-from threading import Lock
-
-#globals/constants for use in the methods
-MAX_DEPTH = 4 #best I've got so far (target is ~8-10) (real AI use ~12-14)
-MAX_THREADS = 2 #number of threads to run, optimal value depends on system (~cores)
-
-#consider moving multithreading to task queue
-#should teach it default move
-
-#Function to run the move determination (wrapper for minmax)
-#Function expects a Forsyth-Edwards Notation (please start on white side, wikipedia is backwards)
-#  also expects the ai color (True=White, False=Black)
-#function will return a character move in long-algebreic-notation
-def get_chess_move(fen_board, color):  
-  state = ai.Board_State(fen_board, color) #construct the board state, make it available globally
-  global global_state   #make top state avaliable to threads
-  global top_max        #make top max avaliable to threads
-  global lock           #make a lock avaliable to the threads
-  global_state = state  
-  top_max = -900000     #need to assign, start at impossibly low value
-  lock = Lock()
+import random
+import atexit
+import os
+import operator
+import threading
+from multiprocessing import Pool, Value
+
+# globals/constants for use in the methods
+MAX_DEPTH = 5 # best I've got so far (target is ~8-10) (real AI use ~12-14)
+MAX_THREADS = 2 # number of threads to run, optimal value depends on system (~cores)
+HASH_MB = 32    # memory cap for the transposition table (per process, or one shared table in lazy smp)
+SMP_MODE = 'root' # how the workers split the search: 'root' hands out root moves, 'lazy' all search the whole tree
+NO_DEADLINE = float('inf') # deadline used when there is no time budget
+TIME_CHECK_MASK = 255      # look at the clock every 256 nodes
+MAX_QDEPTH = 6  # how many captures deep the quiescence search can go past the horizon
+DELTA_MARGIN = 200 # a capture has to get within this much of alpha to be worth searching in quiescence
+ASPIRATION_WINDOW = 50 # each iteration searches this far either side of the last one's score first (0 for full width)
+NULL_MOVE_R = 2 # depth taken off the search after passing the turn in null move pruning (0 turns it off)
+LMR_MOVES = 3   # quiet moves after this many in the ordered list get a shallower search first (0 turns it off)
+LMR_REDUCTION = 1 # how much shallower
+PONDER = False  # keep searching the position after the expected reply once a move has been returned
+FULL_EVAL = False # score mobility and piece squares as well as material
+BATCH_EVAL = False # with FULL_EVAL, score all the children of a depth-1 node at once in NumPy (evaluate_batch)
+BOOK_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'book.bin') # opening book (None for no book)
+TABLEBASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tablebases') # endgame tables
+TB_PIECES = 3 # probe the tablebases once this few pieces are left (kings included)
+
+nodes = 0                 # nodes searched by this process since the last reset
+deadline = NO_DEADLINE    # wall clock time the running search has to stop at
+search_id = 0             # which get_chess_move call the worker's tables were last reset for
+search_count = 0          # get_chess_move calls so far (main process)
+pool = None               # worker processes, started on the first search and kept between moves
+shared_max = Value('i', -900000) # best root value so far this iteration, shared by every worker (root smp)
+shared_stop = Value('b', 0)      # set when one worker finishes the full depth, the rest give up (lazy smp)
+shared_table = None       # transposition table every worker shares (lazy smp only)
+stop_flag = None          # shared_stop while this worker's search may be cut short, None otherwise
+book = None               # the opened opening book, opened on first use
+ponder_job = None         # the pool's answer for the running ponder search, None when not pondering
+engine_lock = threading.RLock() # one search (or ponder start/stop) at a time, ros callbacks come in on their own threads
+search_stats = {'cutoffs': 0, 'first_move_cutoffs': 0, 'qnodes': 0, # counters reported with the result
+  'pvs_researches': 0, 'aspiration_researches': 0, 'null_cutoffs': 0, 'lmr_researches': 0}
+
+# move ordering
+MAX_PLY = 64              # deepest ply the killer table covers
+HISTORY_LIMIT = 1 << 20   # halve the history table when a score passes this (keeps it below the killers)
+MVV_LVA_VALUES = (1, 5, 3, 3, 9, 20) # rough piece worth for ordering captures (pawn, rook, knight, bishop, queen, king)
+ORDER_TT_MOVE = 1 << 30   # sort keys: table move, then captures/promotions, then killers, then history
+ORDER_CAPTURE = 1 << 28
+ORDER_KILLER = 1 << 26
+
+# positional evaluation (FULL_EVAL), white's point of view, black's tables are the same flipped top to bottom
+MOBILITY_WEIGHT = 4       # per square a knight, bishop, rook or queen can move to
+def build_square_table(score): # one bonus per square from a function of (rank, file)
+  return [score(square >> 3, square & 7) for square in range(64)]
+def center_distance(rank, file): # 0 on the middle four squares, 3 on the edge
+  return max(abs(2 * rank - 7), abs(2 * file - 7)) >> 1
+PAWN_ADVANCE = (0, 0, 5, 10, 20, 35, 60, 0)
+SQUARE_BONUS = ( # by piece index: pawn, rook, knight, bishop, queen, king
+  build_square_table(lambda rank, file: PAWN_ADVANCE[rank] + (10 if file in (3, 4) and rank in (3, 4) else 0)),
+  build_square_table(lambda rank, file: 20 if rank == 6 else 0), # rook on the 7th
+  build_square_table(lambda rank, file: 20 - 10 * center_distance(rank, file)),
+  build_square_table(lambda rank, file: 10 - 5 * center_distance(rank, file)),
+  build_square_table(lambda rank, file: 0),
+  build_square_table(lambda rank, file: 15 if rank == 0 and file in (1, 2, 6) else 0)) # castled king
+
+# batched evaluation tables (evaluate_batch), boards are rows of 12 uint64 bitboards in PIECE_NAMES order
+get_boards = operator.attrgetter(*ai.PIECE_NAMES) # a state's 12 bitboards as a tuple
+# material plus square bonus (white's point of view) for every value of each byte of each board: row 8 * piece + byte,
+#   so a position's whole static score is 96 lookups (a byte covers the squares 8 * byte to 8 * byte + 7)
+def piece_square_score(piece, square):
+  if(piece < 6): return ai.PIECE_VALUES[piece] + SQUARE_BONUS[piece][square]
+  return ai.PIECE_VALUES[piece] - SQUARE_BONUS[piece - 6][square ^ 56] # black's tables mirrored
+BATCH_BYTE_SCORES = np.array([[sum(piece_square_score(row >> 3, ((row & 7) << 3) + bit) for bit in range(8) if (value >> bit) & 1)
+  for value in range(256)] for row in range(96)], dtype = np.int32)
+BATCH_BYTE_ROWS = np.arange(96)
+def file_mask(files): # every square except the ones on these files (for shifts that would wrap around the board)
+  mask = 0
+  for file in files: mask |= 0x0101010101010101 << file
+  return np.uint64(~mask & ai.BOARD_MASK)
+NO_MASK, NOT_A, NOT_H, NOT_AB, NOT_GH = file_mask(()), file_mask((0,)), file_mask((7,)), file_mask((0, 1)), file_mask((6, 7))
+# one step in every direction at once, a row per direction: shifts up the board (left) and down it (right),
+#   each masked so nothing wraps around the edge, slider rows are two rook directions then two bishop ones
+#   (sliders get the shift doubled and doubled again too, for the fill in slide_boards)
+def step_column(values): 
+  return np.array(values, dtype = np.uint64).reshape(-1, 1)
+def slide_steps(shifts, masks):
+  return tuple(step_column([shift * times for shift in shifts]) for times in (1, 2, 4)) + (step_column(masks),)
+SLIDE_UP = slide_steps((8, 1, 9, 7), (NO_MASK, NOT_A, NOT_A, NOT_H))
+SLIDE_DOWN = slide_steps((8, 1, 7, 9), (NO_MASK, NOT_H, NOT_A, NOT_H))
+KNIGHT_UP = (step_column((17, 15, 10, 6)), step_column((NOT_A, NOT_H, NOT_AB, NOT_GH)))
+KNIGHT_DOWN = (step_column((6, 10, 15, 17)), step_column((NOT_AB, NOT_GH, NOT_A, NOT_H)))
+killers = [[ai.NO_MOVE, ai.NO_MOVE] for ply in range(MAX_PLY)] # two quiet moves per ply that caused cutoffs
+history = [[0] * 64 for piece in range(12)] # quiet cutoff credit by (piece, to square)
+
+table = ai.Transposition_Table(HASH_MB) # positions we've already searched, kept between moves
+tablebase = ai.Endgame_Tablebase(TABLEBASE_DIR) # exact results for king + piece vs king, built by chess_tablebase.py
+
+def set_meta_vals(depth, threads, hash_mb = None, qdepth = None, smp = None, book_file = None, aspiration = None, 
+    null_move = None, lmr = None, ponder = None, full_eval = None, batch_eval = None):
+  '''Values for the ai program to use (depth, threads, hash_mb, qdepth, smp, book_file, aspiration, null_move, lmr, 
+     ponder, full_eval, batch_eval):
+      depth = Maximum search depth
+      threads = number of simultanious threads to run
+      hash_mb = transposition table size cap in megabytes (optional)
+      qdepth = maximum quiescence (captures only) depth past the horizon (optional, 0 turns it off)
+      smp = parallel search mode (optional), 'root' splits the root moves between the threads,
+        'lazy' has every thread search the whole tree sharing one transposition table
+      book_file = opening book to play from (optional, built with chess_book.py), False to play without one
+      aspiration = half width of the window around the last iteration's score (optional, 0 searches full width)
+      null_move = depth reduction for null move pruning (optional, 0 turns it off)
+      lmr = quiet moves searched at full depth before late move reductions start (optional, 0 turns them off)
+      ponder = True to keep searching on the opponent's time after each move (optional)
+      full_eval = True to score mobility and piece squares on top of material (optional)
+      batch_eval = True to score the depth-1 frontier in NumPy batches when full_eval is on (optional)
+  '''
+  global MAX_DEPTH
+  MAX_DEPTH = depth
+  global MAX_THREADS
+  if(threads != MAX_THREADS): close_pool() # restart at the new size next search
+  MAX_THREADS = threads
+  global HASH_MB
+  global table
+  if(hash_mb is not None and hash_mb != HASH_MB):
+    HASH_MB = hash_mb
+    table = ai.Transposition_Table(HASH_MB) # reallocate at the new size
+    close_pool() # workers have their own tables, restart them with the new size
+  global MAX_QDEPTH
+  if(qdepth is not None and qdepth != MAX_QDEPTH): 
+    MAX_QDEPTH = qdepth
+    close_pool() # workers copied the old value when they started
+  global SMP_MODE
+  if(smp is not None and smp != SMP_MODE):
+    if(smp not in ('root', 'lazy')): raise ValueError('smp mode must be root or lazy')
+    SMP_MODE = smp
+    close_pool() # lazy workers are started with the shared table
+  global BOOK_FILE
+  global book
+  if(book_file is not None):
+    if(book_file is False): book_file = None
+    if(book_file != BOOK_FILE and book is not None):
+      book.close()
+      book = None # open the new one next search
+    BOOK_FILE = book_file
+  global ASPIRATION_WINDOW
+  if(aspiration is not None and aspiration != ASPIRATION_WINDOW):
+    ASPIRATION_WINDOW = aspiration
+    close_pool() # lazy workers read it themselves
+  global NULL_MOVE_R
+  if(null_move is not None and null_move != NULL_MOVE_R):
+    NULL_MOVE_R = null_move
+    close_pool() # workers copied the old value when they started
+  global LMR_MOVES
+  if(lmr is not None and lmr != LMR_MOVES):
+    LMR_MOVES = lmr
+    close_pool()
+  global FULL_EVAL
+  if(full_eval is not None and full_eval != FULL_EVAL):
+    FULL_EVAL = full_eval
+    close_pool() # workers copied the old value when they started
+  global BATCH_EVAL
+  if(batch_eval is not None and batch_eval != BATCH_EVAL):
+    BATCH_EVAL = batch_eval
+    close_pool()
+  global PONDER
+  if(ponder is not None):
+    PONDER = ponder
+    if(not PONDER): stop_ponder()
+
+# start the worker pool if it isn't running (workers live until close_pool, keeping their tables warm)
+def get_pool():
+  global pool
+  global shared_table
+  if(pool is None):
+    if(SMP_MODE == 'lazy'): shared_table = ai.Shared_Transposition_Table(HASH_MB)
+    else: shared_table = None
+    # shared memory has to be handed over at startup, it can't be sent with a job
+    pool = Pool(MAX_THREADS, init_worker, (shared_max, shared_stop, shared_table))
+  return pool
+
+# stop the worker pool (called at exit, and when settings the workers copied change)
+def close_pool():
+  global pool
+  global ponder_job
+  ponder_job = None # goes down with the workers
+  if(pool is not None):
+    pool.terminate()
+    pool.join()
+    pool = None
+
+atexit.register(close_pool)
+
+# runs in each worker as it starts
+def init_worker(shared_value, shared_flag, shared_entries):
+  global shared_max
+  global shared_stop
+  global table
+  shared_max = shared_value
+  shared_stop = shared_flag
+  if(shared_entries is not None): table = shared_entries # lazy smp, search into the common table
+
+# Function to run the move determination (wrapper for minmax)
+# Function expects a Forsyth-Edwards Notation (please start on white side, wikipedia is backwards)
+#   also expects the ai color (True=White, False=Black)
+#   time_budget (optional) is the wall clock allowance in milliseconds
+# Searches depth 1, 2, 3... up to MAX_DEPTH (iterative deepening), each pass ordering the root
+#   moves by the scores of the pass before it, and stops early when the time budget runs out
+#   (split between the workers by root move, or lazy smp, see SMP_MODE)
+# function will return a character move in long-algebreic-notation
+def get_chess_move(fen_board, color, time_budget = None):  
+  with engine_lock: # ros can call in from several threads, one search at a time
+    state = ai.Board_State(fen_board, color) # construct the board state
+    global search_count
+    search_count += 1 # tells the workers to reset their tables for the new position
+  
+    # do some timing things
+    start = time.time()
+    if(time_budget is None): stop_time = NO_DEADLINE
+    else: stop_time = start + time_budget / 1000.0
+    table.new_search(color) # age old entries, reset the hit counters
+    reset_ordering()        # same for the killers and history
   
-  #do some timing things
-  start = time.time()
+    # Start the search
+    counters = dict((name, 0) for name in get_counters()) # summed over every worker and iteration, finished or not
+    ponder = stop_ponder() # the opponent has moved, collect whatever we worked out meanwhile
+    book_move = get_book_move(state)
+    ponder_hit = (book_move == ai.NO_MOVE and ponder is not None and ponder[2] == MAX_DEPTH and 
+      ponder[0] == ai.get_book_key(state) and ponder[1].tag in get_legal_moves(state)) # en passant isn't in the key
+    depth_reached = 0
+    if(book_move != ai.NO_MOVE): # known opening, no need to search
+      best_move = ai.Move(book_move, 0)
+    elif(ponder_hit): # we guessed their move and searched it all the way, nothing left to do
+      best_move, depth_reached = ponder[1], ponder[2]
+      add_counters(counters, ponder[3])
+    elif(not get_legal_moves(state)): # game's over, nothing to play
+      if(state.in_check()): best_move = ai.Move(ai.NO_MOVE, -ai.MATE_VALUE)
+      else: best_move = ai.Move(ai.NO_MOVE, 0) # stalemate
+    else:
+      workers = get_pool() # worker processes stay up between calls
+      if(SMP_MODE == 'lazy'):
+        shared_table.new_search(color) # workers share this one, only we age it
+        best_move, depth_reached = lazy_smp_search(state, workers, stop_time, counters)
+      else:
+        best_move, depth_reached = root_split_search(state, workers, start, stop_time, counters)
+    
+    # debug (single thread instead of multi)
+    # best_move = alpha_beta_max(state, MAX_DEPTH, -900000, 900000)
+
+    # See if we've checked or mated them
+    check_or_mate = None
+    new_state = ai.Board_State() # create the new state
+    new_state.copy_board(state)
+    new_state.make_move(best_move.tag) # execute our chosen move
+    if(best_move.tag == ai.NO_MOVE): pass # no move to play
+    elif(new_state.in_check()):
+      if(get_legal_moves(new_state)): check_or_mate = 'Check'
+      else: check_or_mate = 'Checkmate' # in check with no way out
   
-  #Start the search
-  pool = Pool(MAX_THREADS) #spawn specified number of worker threads
-  move_strings = get_possible_moves(state) #get all possible first moves
-  moves = pool.map(do_search_thread, move_strings) #run the threads
-  pool.close() #close threads after they finish
-  pool.join() #wait for threads to terminate before continuing
+    tt_info = {'probes': counters['tt_probes'], 'hits': counters['tt_hits'], 'stores': counters['tt_stores'], 
+      'rejects': counters['tt_rejects']}
+    tt_info['hit_rate'] = float(tt_info['hits']) / max(tt_info['probes'], 1)
+    stats = {'cutoffs': counters['cutoffs'], 'first_move_cutoffs': counters['first_move_cutoffs'], 
+      'pvs_researches': counters['pvs_researches'], 'aspiration_researches': counters['aspiration_researches'], 
+      'null_cutoffs': counters['null_cutoffs'], 'lmr_researches': counters['lmr_researches']}
+    stats['first_move_cutoff_rate'] = float(stats['first_move_cutoffs']) / max(stats['cutoffs'], 1) # ordering quality
+    search_time = time.time() - start
+    if(PONDER and best_move.tag != ai.NO_MOVE and check_or_mate != 'Checkmate'): 
+      start_ponder(new_state) # work on their reply while they think
+    return {'move': ai.move_to_string(best_move.tag), 'check': check_or_mate, 'value':best_move.value, 'time':search_time, 
+      'book':book_move != ai.NO_MOVE, 'depth':depth_reached, 'nodes':counters['nodes'], 'qnodes':counters['qnodes'], 
+      'nps':counters['nodes'] / max(search_time, 1e-6), 'tt':tt_info, 'stats':stats, 'ponder':ponder_hit}
+
+# start a ponder search of the position after our move (theirs to play) in a worker, returns right away
+def start_ponder(state):
+  global ponder_job
+  with engine_lock:
+    stop_ponder() # only one at a time
+    shared_stop.value = 0
+    ponder_job = get_pool().apply_async(do_ponder_thread, ((state, search_count),))
+
+# stop the ponder search and wait for the worker to give it up
+# returns (position key, best move, depth, counters) for the position pondered, None if nothing was pondered
+# safe to call any time (from any thread), get_chess_move calls it itself
+def stop_ponder():
+  global ponder_job
+  with engine_lock:
+    if(ponder_job is None): return None
+    shared_stop.value = 1 # the worker checks this with the clock
+    result = ponder_job.get()
+    ponder_job = None
+    shared_stop.value = 0
+    return result
+
+# pick a move for the position from the opening book, weighted by how often it was played
+# returns NO_MOVE if there's no book or the position isn't in it
+def get_book_move(state):
+  global book
+  if(BOOK_FILE is None): return ai.NO_MOVE
+  if(book is None):
+    if(not os.path.exists(BOOK_FILE)): return ai.NO_MOVE
+    book = ai.Opening_Book(BOOK_FILE)
+  legal_moves = get_legal_moves(state)
+  choices = [(move, weight) for move, weight in book.get_moves(state) if move in legal_moves] # skip key collisions
+  total = sum(weight for move, weight in choices)
+  if(not total): return ai.NO_MOVE
+  pick = random.randrange(total)
+  for move, weight in choices:
+    pick -= weight
+    if(pick < 0): return move
+
+# root splitting: searches depth 1, 2, 3... handing the root moves out to the workers one at a time
+# stops early when the next iteration won't fit in the time left
+# returns (best move, depth of the last complete iteration), adds the workers' counters into counters
+def root_split_search(state, workers, start, stop_time, counters):
+  move_list = get_legal_moves(state) # get all possible first moves
+  random.shuffle(move_list) # shuffle the moves (random pick between equal moves)
+  moves = None            # results of the deepest completed iteration
+  depth_reached = 0       # depth of that iteration
+  timed_out = False
+  for depth in range(1, MAX_DEPTH+1):
+    if(depth > 1 and (time.time() - start) * 2 > (stop_time - start)):
+      break # next iteration costs more than everything so far, it won't finish in what's left
+    deadline = stop_time if depth > 1 else NO_DEADLINE # always finish depth 1 so we have a move
+    alpha, beta = get_aspiration_window(moves, depth)
+    while(True):
+      shared_max.value = alpha # new iteration, last iteration's bound doesn't apply
+      shared_stop.value = 0
+      # the pool hands jobs out in order as workers free up, so it works through the root moves best-first
+      jobs = [(state, move, depth, deadline, search_count, beta) for move in move_list]
+      results = list(workers.imap_unordered(do_search_thread, jobs)) # run the threads
+      for result in results: add_counters(counters, result[1])
+      if(None in [result[0] for result in results]):
+        timed_out = True
+        break
+      best_value = max(result[0].value for result in results)
+      if(best_value >= beta and beta < 900000): beta = 900000   # better than we guessed, open the top
+      elif(best_value <= alpha and alpha > -900000): alpha = -900000 # worse, open the bottom
+      else: break
+      counters['aspiration_researches'] += 1
+    if(timed_out):
+      shared_stop.value = 0 # clear it again so our own searches aren't stopped
+      break # ran out of time partway, keep the last complete iteration
+    moves = [result[0] for result in results]
+    depth_reached = depth
+    # principal variation first next time, then the rest by score
+    moves.sort(key = lambda move: -move.value)
+    move_list = [move.tag for move in moves]
   
-  best_move = moves[0]
-  all_equal = True  #check if all moves are equal
-  for move in moves[1:]: #get best move
-    if(move.value > best_move.value): 
-      best_move = move
-      all_equal = False
-      print 'better_move'
+  # find the best move value
+  best_move_val = moves[0].value
+  for move in moves[1:]: # get best move
+    if(move.value > best_move_val): 
+      best_move_val = move.value
   
-  #pick random move instead if all moves are the same value
-  if(all_equal):
-    best_move = moves[randrange(len(moves))]
+  good_moves = [] # list of the top moves
+  for move in moves:
+    if(move.value == best_move_val):
+      good_moves.append(move) # add the move
+      # print (move.tag, move.value)
   
-  #debug (single thread instead of multi)
-  #best_move = alpha_beta_tree(state, MAX_DEPTH, None, None, True)
-
-  #See if we've checked them (give ai a free second move, see if we capture the king)
-  new_state = ai.Board_State() #create the new state
-  new_state.copy_board(state)
-  new_state.execute_move(best_move.tag,False) #execute our chosen move and take another turn
-  check_check = alpha_beta_tree(new_state, 1, None, None, True) #check tree
-  new_state.execute_move(check_check.tag) #execute the free move
-  if(new_state.ai_color and not new_state.bk): print 'Check'
-  elif(not new_state.ai_color and not new_state.wk): print 'Check'
-    
-  #See if we've checkmated them (iterate one round, see if they survive)
-  new_state.copy_board(state)
-  new_state.execute_move(best_move.tag) #execute our chosen move
-  check_check = alpha_beta_tree(new_state, 2, None, None, False) #do thier turn
-  new_state.execute_move(check_check.tag)
-  check_check = alpha_beta_tree(new_state, 1, None, None, True)  #do our turn
-  new_state.execute_move(check_check.tag)
-  if(new_state.ai_color and not new_state.bk): print 'Checkmate'
-  elif(not new_state.ai_color and not new_state.wk): print 'Checkmate'
+  # print ('good moves', len(good_moves))
   
-  return best_move.tag
+  # pick random move from top contender list
+  best_move = good_moves[random.randrange(len(good_moves))]
+  return (best_move, depth_reached)
+
+# window for an iteration's root search: the last iteration's best score plus or minus ASPIRATION_WINDOW
+# moves is the last iteration's results, None (or depth 1) gets the full window
+def get_aspiration_window(moves, depth):
+  if(moves is None or depth == 1 or not ASPIRATION_WINDOW): return (-900000, 900000)
+  best_value = max(move.value for move in moves)
+  return (best_value - ASPIRATION_WINDOW, best_value + ASPIRATION_WINDOW)
+
+# lazy smp: every worker runs its own iterative deepening over the whole tree, all sharing one table
+#   so each one skips the work the others have already stored, and none of them sit idle
+# returns (best move, depth reached) from whichever worker got deepest, adds the counters into counters
+def lazy_smp_search(state, workers, stop_time, counters):
+  shared_stop.value = 0
+  jobs = [(state, index, stop_time, search_count, random.getrandbits(32)) for index in range(MAX_THREADS)]
+  results = list(workers.imap_unordered(do_lazy_thread, jobs)) # finishing order, first done first
+  shared_stop.value = 0 # clear it again so our own searches aren't stopped
+  best_move = None
+  depth_reached = 0
+  for result in results:
+    add_counters(counters, result[2])
+    if(result[1] > depth_reached): # deepest wins, ties go to whoever finished first
+      best_move, depth_reached = result[0], result[1]
+  return (best_move, depth_reached)
+
+# snapshot of this process's search counters
+def get_counters():
+  probes, hits, stores, rejects = table.get_stats()
+  counters = {'nodes': nodes, 'tt_probes': probes, 'tt_hits': hits, 'tt_stores': stores, 'tt_rejects': rejects}
+  counters.update(search_stats)
+  return counters
+
+# add one set of counters into a running total
+def add_counters(total, counters):
+  for name in counters:
+    total[name] = total.get(name, 0) + counters[name]
+
+# forget the killer moves and fade the history scores, call before a new search
+def reset_ordering():
+  for ply in range(MAX_PLY):
+    killers[ply][0] = killers[ply][1] = ai.NO_MOVE
+  for piece_history in history:
+    for square in range(64):
+      piece_history[square] >>= 2 # old results still hint, but the new position matters more
 
-#wrapper function for tree search, will spawn single search thread
-#function must run from top level, and always assumes the ai is moving
-def do_search_thread(move):
-  global global_state   #use global state
-  global top_max        #use global max
-  global lock           #use global lock
+# wrapper function for tree search, runs one root move in a worker process
+# function must run from top level, and always assumes the ai is moving
+# job is (root state, root move, iteration depth, deadline, search number, top of the aspiration window)
+# returns (move or None if the deadline hit, search counters this job added)
+def do_search_thread(job):
+  global search_id      # search the worker's tables belong to
+  global deadline       # time the search has to give up at
+  global stop_flag
+  new_state, move, depth, deadline, job_search, beta = job # the state is our own copy, the whole search runs on it
   
-  #print move
+  if(job_search != search_id): # first job of a new get_chess_move
+    search_id = job_search
+    table.new_search(new_state.ai_color)
+    reset_ordering()
   
-  new_state = ai.Board_State()  #create a new state
-  new_state.copy_board(global_state) #copy the main state
-  new_state.execute_move(move)  #execute the move
+  # print move
   
-  lock.acquire() #get the lock
-  gmax = top_max #copy the global max
-  lock.release() #release the lock
+  new_state.make_move(move)  # execute the move
+  gmax = shared_max.value    # best any worker has found so far this iteration
   
-  best_move = alpha_beta_tree(new_state, MAX_DEPTH-1, gmax, None, False) #throw to tree search for next iteration
+  counters_before = get_counters()
+  stop_flag = shared_stop # whichever job runs out of time first stops the rest
+  try:
+    check_time() # the deadline may have passed while this job waited in the queue
+    best_move = alpha_beta_min(new_state, depth-1, gmax, beta, 1) # throw to tree search for next iteration
+  except ai.Search_Timeout:
+    shared_stop.value = 1 # out of time, the jobs still queued give up without searching
+    best_move = None # out of time, result is meaningless
+  stop_flag = None
+  counters = get_counters()
+  for name in counters: counters[name] -= counters_before[name]
+  if(best_move is None): return (None, counters)
+  if(best_move.value <= gmax): return (ai.Move(move,-900000), counters) # failed low, can't beat what we have
 
-  lock.acquire() #get the lock
-  if(top_max < best_move.value): #check if we're better
-    top_max = best_move.value #store new best value
-  lock.release() #release the lock
+  with shared_max.get_lock(): # let the other workers prune against us
+    if(shared_max.value < best_move.value): # check if we're better
+      shared_max.value = best_move.value # store new best value
   
   best_move.tag = move
+  return (best_move, counters)
+
+# lazy smp worker, runs a whole iterative deepening search of the root into the shared table
+# job is (root state, worker index, stop time, search number, random seed)
+# worker 0 walks every depth, the helpers skip every other depth (odd helpers the even depths, even helpers
+#   the odd) so they run ahead and fill the table with deeper results than the ones being searched
+# returns (best move of the deepest finished depth, that depth, search counters this job added)
+def do_lazy_thread(job):
+  global search_id
+  global deadline
+  global stop_flag
+  state, index, stop_time, job_search, seed = job
+  if(job_search != search_id): # first job of a new get_chess_move
+    search_id = job_search
+    reset_ordering()
+  
+  move_list = get_legal_moves(state)
+  random.Random(seed).shuffle(move_list) # each worker starts down a different line
+  best_move = None
+  depth_reached = 0
+  deadline = NO_DEADLINE # always finish depth 1 so we have a move
+  counters_before = get_counters()
+  for depth in range(1, MAX_DEPTH+1):
+    if(index and depth > 1 and depth < MAX_DEPTH and (depth + index) & 1): continue # helper, skip this one
+    try:
+      best_move = search_root_window(state, move_list, depth, best_move)
+    except ai.Search_Timeout:
+      break # out of time or someone else finished, the state is left mid-search but we're done with it
+    depth_reached = depth
+    deadline = stop_time   # have a move, the rest can be cut short
+    stop_flag = shared_stop
+  if(depth_reached == MAX_DEPTH): shared_stop.value = 1 # full depth done, tell the others to stop
+  stop_flag = None
+  deadline = NO_DEADLINE
+  counters = get_counters()
+  for name in counters: counters[name] -= counters_before[name]
+  return (best_move, depth_reached, counters)
+
+# ponder worker: guesses the opponent's reply to our move, then deepens on the position after it into the table
+#   until the full depth is done or stop_ponder sets shared_stop
+# the table is only everyone's in lazy smp, in root smp it's this worker's own and the others start cold
+# job is (state after our move, search number)
+# returns (key of the pondered position, best move, depth finished, search counters this job added),
+#   the key is None if it was stopped before the guess was made
+def do_ponder_thread(job):
+  global search_id
+  global deadline
+  global stop_flag
+  state, job_search = job
+  if(job_search != search_id):
+    search_id = job_search
+    reset_ordering()
+  
+  ponder_key = None
+  best_move = None
+  depth_reached = 0
+  deadline = NO_DEADLINE
+  stop_flag = shared_stop # no clock, only stop_ponder ends it
+  counters_before = get_counters()
+  try:
+    reply = guess_reply(state, max(MAX_DEPTH-1, 1))
+    if(reply != ai.NO_MOVE): # they aren't stalemated
+      state.make_move(reply)
+      ponder_key = ai.get_book_key(state) # FENs off the board may not know the en passant square
+      move_list = get_legal_moves(state)
+      for depth in range(1, MAX_DEPTH+1):
+        if(not move_list): break # they mate us, nothing to ponder
+        best_move = search_root_window(state, move_list, depth, best_move)
+        depth_reached = depth
+  except ai.Search_Timeout:
+    pass # stopped, keep what finished
+  stop_flag = None
+  counters = get_counters()
+  for name in counters: counters[name] -= counters_before[name]
+  return (ponder_key, best_move, depth_reached, counters)
+
+# the opponent's best reply in a position they're on the move in, searched to depth (NO_MOVE if they have none)
+def guess_reply(state, depth):
+  move_list = get_legal_moves(state)
+  if(not move_list): return ai.NO_MOVE
+  entry = table.probe(state.hash)
+  if(entry is not None): order_moves(move_list, entry[4], 0)
+  else: order_moves(move_list, ai.NO_MOVE, 0)
+  best_move = ai.Move(move_list[0], 900000)
+  for move in move_list:
+    undo = state.make_move(move)
+    contender = alpha_beta_max(state, depth-1, -900000, best_move.value, 1).value
+    state.unmake_move(undo)
+    if(contender < best_move.value): best_move = ai.Move(move, contender)
+  return best_move.tag
+
+# search_root in a window around the last depth's result (best_move, None for the first depth), opening
+#   whichever side the score falls out of until it lands inside
+def search_root_window(state, move_list, depth, best_move):
+  if(best_move is None or not ASPIRATION_WINDOW): alpha, beta = -900000, 900000
+  else: alpha, beta = best_move.value - ASPIRATION_WINDOW, best_move.value + ASPIRATION_WINDOW
+  while(True):
+    result = search_root(state, move_list, depth, alpha, beta)
+    if(result.value >= beta and beta < 900000): beta = 900000 # outside the window, open that side
+    elif(result.value <= alpha and alpha > -900000): alpha = -900000
+    else: return result
+    search_stats['aspiration_researches'] += 1
+
+# search every root move to depth inside (alpha, beta), narrowing the window as better moves turn up
+# principal variation search: after the first move the rest only get a null window, proving they're no
+#   better, and are searched again properly if one turns out to be
+# moves the best one to the front of move_list so the next depth tries it first
+# returns the best move with its tag set (value alpha or less if nothing got inside, beta or more if one beat it)
+def search_root(state, move_list, depth, alpha = -900000, beta = 900000):
+  best_move = ai.Move(move_list[0], alpha)
+  for index, move in enumerate(move_list):
+    undo = state.make_move(move)
+    if(index == 0): contender = alpha_beta_min(state, depth-1, best_move.value, beta, 1).value
+    else:
+      contender = alpha_beta_min(state, depth-1, best_move.value, best_move.value + 1, 1).value
+      if(contender > best_move.value and best_move.value + 1 < beta):
+        search_stats['pvs_researches'] += 1
+        contender = alpha_beta_min(state, depth-1, best_move.value, beta, 1).value
+    state.unmake_move(undo)
+    if(contender > best_move.value): best_move = ai.Move(move, contender)
+    if(contender >= beta): break # fails high, the caller opens the window
+  move_list.remove(best_move.tag)
+  move_list.insert(0, best_move.tag)
   return best_move
 
-#recursive function to generate tree
-#argumengs are: board state, remaining depth,
-#  most recent min, most recent max, current operation (max/min)
-#function returns the optimal move
-def alpha_beta_tree(state, depth, last_max, last_min, is_max):
-  if(depth == 0): #end of recursive function
-    return ai.Move("", get_state_evaluation(state))  #return the value of this position
+# raise Search_Timeout if the deadline has passed or another worker told us to stop
+def check_time():
+  if(time.time() > deadline or (stop_flag is not None and stop_flag.value)):
+    raise ai.Search_Timeout()
+
+# first of pair of recursive functions to generate tree (max half of it)
+# argumengs are: board state, remaining depth, most recent min, most recent max, distance from the root,
+#   whether passing the turn is allowed here (not twice in a row), and the static score if it's already known
+# null move pruning: in a null window node, if passing still beats the window on a shallower search, a real
+#   move will too, skipped in check and with only pawns left (zugzwang, where passing would be the best move)
+# late move reductions: quiet moves ordered late are searched a little shallower first, and only get the
+#   full depth if that says they're good
+# function returns the optimal move
+def alpha_beta_max(state, depth, last_max, last_min, ply = 0, null_ok = True, stand_pat = None):
+  if(ply and state.is_repetition()): return ai.Move(ai.NO_MOVE, 0) # repeating is a draw
+  if(ply and state.piece_count <= TB_PIECES): # known ending, the table has the exact answer
+    score = tablebase.probe(state, ply)
+    if(score is not None): return ai.Move(ai.NO_MOVE, score)
+  if(depth == 0): # end of recursive function, settle the captures before scoring the position
+    return ai.Move(ai.NO_MOVE, quiesce_max(state, last_max, last_min, MAX_QDEPTH, ply, stand_pat))
+  global nodes
+  nodes += 1
+  if(not (nodes & TIME_CHECK_MASK)): check_time() # unwinds the whole search if we're out of time
+  
+  entry = table.probe(state.hash, ply) # have we searched this position before?
+  if(entry is not None and entry[1] >= depth): # stored result is deep enough to trust
+    if(entry[2] == ai.TT_EXACT): return ai.Move(entry[4], entry[3])
+    if(entry[2] == ai.TT_LOWER and entry[3] >= last_min): return ai.Move(ai.NO_MOVE,last_min)
+    if(entry[2] == ai.TT_UPPER and entry[3] <= last_max): return ai.Move(ai.NO_MOVE,last_max)
+  
+  if(null_ok and NULL_MOVE_R and depth > NULL_MOVE_R and last_min - last_max == 1 and has_pieces(state) 
+     and get_state_evaluation(state) >= last_min and not state.in_check()): # try passing
+    undo = state.make_null_move()
+    contender = alpha_beta_min(state, depth-1-NULL_MOVE_R, last_min-1, last_min, ply+1, False).value
+    state.unmake_move(undo)
+    if(contender >= last_min): # still too good, they'd never allow this
+      search_stats['null_cutoffs'] += 1
+      return ai.Move(ai.NO_MOVE,last_min)
     
-  move_strings = get_possible_moves(state) #get the strings corresponding to possible moves
-  if(len(move_strings) == 0): return ai.Move("",get_state_evaluation(state)) #handle edge case
+  move_list = get_legal_moves(state) # get the possible moves
+  if(len(move_list) == 0): # game over
+    if(state.in_check()): return ai.Move(ai.NO_MOVE, ply - ai.MATE_VALUE) # we're mated
+    return ai.Move(ai.NO_MOVE, 0) # stalemate
+  if(entry is not None): order_moves(move_list, entry[4], ply) # stored best move first, then the rest
+  else: order_moves(move_list, ai.NO_MOVE, ply)
+  reduce_from = len(move_list) # moves from here on can be reduced
+  if(LMR_MOVES and depth >= 3 and not state.in_check()): reduce_from = LMR_MOVES
+  child_scores = None # frontier with the full evaluation: score every child at once
+  if(depth == 1 and BATCH_EVAL and FULL_EVAL): child_scores = evaluate_children(state, move_list)
   
-  new_state = ai.Board_State()
-  new_state.copy_board(state)
-  new_state.execute_move(move_strings[0])
-  if(is_max): best_move = alpha_beta_tree(new_state, depth-1, None, last_min, False)
-  else: best_move = alpha_beta_tree(new_state, depth-1, last_max, None, True)
-  best_move.tag = move_strings[0]  
+  best_move = ai.Move(ai.NO_MOVE,last_max)  # preload move
+  for index, move in enumerate(move_list): # search each move
+    undo = state.make_move(move)    # execute the move in place
+    child_score = child_scores[index] if child_scores else None
+    if(index == 0): # principal variation, full window
+      contender = alpha_beta_min(state, depth-1, last_max, last_min, ply+1, True, child_score).value # recurse!
+    else: # null window, just prove it's no better than what we have
+      reduction = 0
+      if(index >= reduce_from and is_quiet(move) and not state.in_check()): reduction = LMR_REDUCTION # late and quiet
+      contender = alpha_beta_min(state, depth-1-reduction, last_max, last_max+1, ply+1, True, child_score).value
+      if(contender > last_max and reduction): # the shallow search liked it, check at full depth
+        search_stats['lmr_researches'] += 1
+        contender = alpha_beta_min(state, depth-1, last_max, last_max+1, ply+1, True, child_score).value
+      if(contender > last_max and last_max+1 < last_min): # it is better, find out by how much
+        search_stats['pvs_researches'] += 1
+        contender = alpha_beta_min(state, depth-1, last_max, last_min, ply+1, True, child_score).value
+    state.unmake_move(undo)         # and take it back
+    if(contender >= last_min): # no moves
+      record_cutoff(move, index, depth, ply)
+      table.store(state.hash, depth, ai.TT_LOWER, last_min, move, ply) # refutation, at least this good
+      return ai.Move(ai.NO_MOVE,last_min)
+    if(contender > last_max): # check result
+      last_max = contender
+      best_move = ai.Move(move, contender) # contender is better
+
+  if(best_move.tag == ai.NO_MOVE): table.store(state.hash, depth, ai.TT_UPPER, last_max, ai.NO_MOVE, ply) # nothing beat alpha
+  else: table.store(state.hash, depth, ai.TT_EXACT, best_move.value, best_move.tag, ply)
+  return best_move  # successfull move
+
+
+# second half of recursive pair
+def alpha_beta_min(state, depth, last_max, last_min, ply = 0, null_ok = True, stand_pat = None):
+  if(ply and state.is_repetition()): return ai.Move(ai.NO_MOVE, 0) # repeating is a draw
+  if(ply and state.piece_count <= TB_PIECES): # known ending, the table has the exact answer
+    score = tablebase.probe(state, ply)
+    if(score is not None): return ai.Move(ai.NO_MOVE, score)
+  if(depth == 0): # end of recursive function, settle the captures before scoring the position
+    return ai.Move(ai.NO_MOVE, quiesce_min(state, last_max, last_min, MAX_QDEPTH, ply, stand_pat))
+  global nodes
+  nodes += 1
+  if(not (nodes & TIME_CHECK_MASK)): check_time() # unwinds the whole search if we're out of time
   
-  for move in move_strings[1:]:   #search each other move
-    new_state.copy_board(state)   #copy the board
-    new_state.execute_move(move)  #execute the move
-    if(is_max): contender = alpha_beta_tree(new_state, depth-1, best_move.value, last_min, False) #recurse!
-    else: contender = alpha_beta_tree(new_state, depth-1, last_max, best_move.value, True) #recurse!
-    if((is_max and contender.value >= best_move.value) or (not is_max and contender.value <= best_move.value)):
-      best_move = contender #contender is better
-      best_move.tag = move  #update the tag
-      #Do alpha beta - remove any value which cannot possiby replace an existing one
-      if(last_max != None and last_min != None):
-        if(best_move.value >= last_min or best_move.value <= last_max): return best_move 
-      elif(last_max != None and best_move.value <= last_max): return best_move
-      elif(last_min != None and best_move.value >= last_min):  return best_move
+  entry = table.probe(state.hash, ply) # have we searched this position before?
+  if(entry is not None and entry[1] >= depth): # stored result is deep enough to trust
+    if(entry[2] == ai.TT_EXACT): return ai.Move(entry[4], entry[3])
+    if(entry[2] == ai.TT_LOWER and entry[3] >= last_min): return ai.Move(ai.NO_MOVE,last_min)
+    if(entry[2] == ai.TT_UPPER and entry[3] <= last_max): return ai.Move(ai.NO_MOVE,last_max)
   
-  return best_move
+  if(null_ok and NULL_MOVE_R and depth > NULL_MOVE_R and last_min - last_max == 1 and has_pieces(state) 
+     and get_state_evaluation(state) <= last_max and not state.in_check()): # try passing
+    undo = state.make_null_move()
+    contender = alpha_beta_max(state, depth-1-NULL_MOVE_R, last_max, last_max+1, ply+1, False).value
+    state.unmake_move(undo)
+    if(contender <= last_max): # still too good for them, we'd never allow this
+      search_stats['null_cutoffs'] += 1
+      return ai.Move(ai.NO_MOVE,last_max)
+    
+  move_list = get_legal_moves(state) # get the possible moves
+  if(len(move_list) == 0): # game over
+    if(state.in_check()): return ai.Move(ai.NO_MOVE, ai.MATE_VALUE - ply) # they're mated
+    return ai.Move(ai.NO_MOVE, 0) # stalemate
+  if(entry is not None): order_moves(move_list, entry[4], ply) # stored best move first, then the rest
+  else: order_moves(move_list, ai.NO_MOVE, ply)
+  reduce_from = len(move_list) # moves from here on can be reduced
+  if(LMR_MOVES and depth >= 3 and not state.in_check()): reduce_from = LMR_MOVES
+  child_scores = None # frontier with the full evaluation: score every child at once
+  if(depth == 1 and BATCH_EVAL and FULL_EVAL): child_scores = evaluate_children(state, move_list)
+  
+  best_move = ai.Move(ai.NO_MOVE,last_min)  # preload move
+  for index, move in enumerate(move_list): # search each move
+    undo = state.make_move(move)    # execute the move in place
+    child_score = child_scores[index] if child_scores else None
+    if(index == 0): # principal variation, full window
+      contender = alpha_beta_max(state, depth-1, last_max, last_min, ply+1, True, child_score).value # recurse!
+    else: # null window, just prove it's no worse for us than what we have
+      reduction = 0
+      if(index >= reduce_from and is_quiet(move) and not state.in_check()): reduction = LMR_REDUCTION # late and quiet
+      contender = alpha_beta_max(state, depth-1-reduction, last_min-1, last_min, ply+1, True, child_score).value
+      if(contender < last_min and reduction): # the shallow search liked it, check at full depth
+        search_stats['lmr_researches'] += 1
+        contender = alpha_beta_max(state, depth-1, last_min-1, last_min, ply+1, True, child_score).value
+      if(contender < last_min and last_max < last_min-1): # it is, find out by how much
+        search_stats['pvs_researches'] += 1
+        contender = alpha_beta_max(state, depth-1, last_max, last_min, ply+1, True, child_score).value
+    state.unmake_move(undo)         # and take it back
+    if(contender <= last_max): # no moves
+      record_cutoff(move, index, depth, ply)
+      table.store(state.hash, depth, ai.TT_UPPER, last_max, move, ply) # refutation, at most this good
+      return ai.Move(ai.NO_MOVE,last_max)
+    if(contender < last_min): # check result
+      last_min = contender
+      best_move = ai.Move(move, contender) # contender is better
+
+  if(best_move.tag == ai.NO_MOVE): table.store(state.hash, depth, ai.TT_LOWER, last_min, ai.NO_MOVE, ply) # nothing beat beta
+  else: table.store(state.hash, depth, ai.TT_EXACT, best_move.value, best_move.tag, ply)
+  return best_move  # successfull move
+
+
+
+# quiescence search, the max half: keep playing captures past the horizon until the position is quiet
+#   so we don't score a position halfway through a trade (same arguments as alpha_beta_max plus captures left)
+# stand pat: we don't have to capture, so the static score is a floor for us (passed in if the frontier
+#   node scored its children in one batch)
+# delta pruning: skip captures that can't bring us back up to alpha even with a margin
+# returns the value (fail hard, like the alpha-beta pair)
+def quiesce_max(state, last_max, last_min, qdepth, ply, stand_pat = None):
+  global nodes
+  nodes += 1
+  search_stats['qnodes'] += 1
+  if(not (nodes & TIME_CHECK_MASK)): check_time()
+  if(stand_pat is None): stand_pat = get_state_evaluation(state) # not scored already in a batch
+  # can't stand pat in check, every way out gets tried (only right past the horizon, where the last full move
+  #   may have checked, deeper checks from captures are left to stand pat to keep the tree small)
+  evading = (qdepth == MAX_QDEPTH and qdepth > 0 and state.in_check())
+  if(evading):
+    move_list = get_legal_moves(state)
+    if(not move_list): return max(last_max, min(ply - ai.MATE_VALUE, last_min)) # mated, inside the window like any score
+  else:
+    if(stand_pat >= last_min): return last_min # already too good, they won't allow this
+    if(stand_pat > last_max): last_max = stand_pat
+    if(qdepth <= 0): return last_max # out of quiescence depth
+    move_list = get_legal_moves(state, True) # captures (and promotions) only
+  order_moves(move_list, ai.NO_MOVE, ply)
+  for move in move_list:
+    captured = (move >> 16) & 15
+    if(not evading and captured != ai.NO_PIECE and stand_pat + abs(ai.PIECE_VALUES[captured]) + DELTA_MARGIN <= last_max):
+      continue # delta pruning, hopeless even if we win the piece for free
+    undo = state.make_move(move)
+    contender = quiesce_min(state, last_max, last_min, qdepth-1, ply+1)
+    state.unmake_move(undo)
+    if(contender >= last_min): return last_min
+    if(contender > last_max): last_max = contender
+  return last_max
+
+# quiescence search, the min half (the opponent's static score is a ceiling for us)
+def quiesce_min(state, last_max, last_min, qdepth, ply, stand_pat = None):
+  global nodes
+  nodes += 1
+  search_stats['qnodes'] += 1
+  if(not (nodes & TIME_CHECK_MASK)): check_time()
+  if(stand_pat is None): stand_pat = get_state_evaluation(state) # not scored already in a batch
+  evading = (qdepth == MAX_QDEPTH and qdepth > 0 and state.in_check())
+  if(evading):
+    move_list = get_legal_moves(state)
+    if(not move_list): return min(last_min, max(ai.MATE_VALUE - ply, last_max)) # they're mated
+  else:
+    if(stand_pat <= last_max): return last_max # already too good for us, they won't allow this
+    if(stand_pat < last_min): last_min = stand_pat
+    if(qdepth <= 0): return last_min # out of quiescence depth
+    move_list = get_legal_moves(state, True) # captures (and promotions) only
+  order_moves(move_list, ai.NO_MOVE, ply)
+  for move in move_list:
+    captured = (move >> 16) & 15
+    if(not evading and captured != ai.NO_PIECE and stand_pat - abs(ai.PIECE_VALUES[captured]) - DELTA_MARGIN >= last_min):
+      continue # delta pruning
+    undo = state.make_move(move)
+    contender = quiesce_max(state, last_max, last_min, qdepth-1, ply+1)
+    state.unmake_move(undo)
+    if(contender <= last_max): return last_max
+    if(contender < last_min): last_min = contender
+  return last_min
+
+# sort moves best-guess first so alpha-beta cuts off early:
+#   the transposition table's move, captures by most valuable victim / least valuable attacker (and promotions),
+#   the two killer moves for this ply, then quiet moves by their history score
+def order_moves(move_list, tt_move, ply):
+  killer_1, killer_2 = killers[min(ply, MAX_PLY - 1)]
+  def order_key(move):
+    if(move == tt_move): return ORDER_TT_MOVE
+    captured = (move >> 16) & 15
+    if(captured != ai.NO_PIECE): 
+      return ORDER_CAPTURE + (MVV_LVA_VALUES[captured % 6] << 5) - MVV_LVA_VALUES[((move >> 12) & 15) % 6]
+    if((move >> 20) & ai.MOVE_PROMOTION): return ORDER_CAPTURE + ((move >> 20) & 3) # queen promotions first
+    if(move == killer_1): return ORDER_KILLER + 1
+    if(move == killer_2): return ORDER_KILLER
+    return history[(move >> 12) & 15][(move >> 6) & 63]
+  move_list.sort(key = order_key, reverse = True)
+
+# quiet moves are the ones that don't capture or promote
+def is_quiet(move):
+  return ((move >> 16) & 15) == ai.NO_PIECE and not (move >> 20) & ai.MOVE_PROMOTION
+
+# does the side on the move have anything besides its king and pawns (null moves aren't safe without)
+def has_pieces(state):
+  if(state.turn == state.ai_color): return bool(state.wr | state.wn | state.wb | state.wq)
+  return bool(state.br | state.bn | state.bb | state.bq)
 
-#function counts the peices remaining on the board, and multiplies by thier weight (Kauffman's 2012 values)
-#super simple first draft, will probably improve later
+# bookkeeping when a move causes a cutoff: stats, and killer/history credit if it was a quiet move
+def record_cutoff(move, index, depth, ply):
+  search_stats['cutoffs'] += 1
+  if(index == 0): search_stats['first_move_cutoffs'] += 1
+  if(not is_quiet(move)): return # ordered by capture value already
+  killer = killers[min(ply, MAX_PLY - 1)] # same clamp as order_moves, deep lines share the last slot
+  if(killer[0] != move): # newest killer in the first slot
+    killer[1] = killer[0]
+    killer[0] = move
+  piece_history = history[(move >> 12) & 15]
+  piece_history[(move >> 6) & 63] += depth * depth # deep cutoffs count for more
+  if(piece_history[(move >> 6) & 63] > HISTORY_LIMIT):
+    for piece_history in history:
+      for square in range(64):
+        piece_history[square] >>= 1
+
+# function counts the peices remaining on the board, and multiplies by thier weight (Kauffman's 2012 values)
+# super simple first draft, will probably improve later
+# the board keeps running totals of both (ai.PIECE_VALUES), so this is constant time
 def get_state_evaluation(state):
-  score = 0 #position is initially neutral
-  score += bin(state.wp).count("1")*100  #count the 1's in the bitmap
-  score -= bin(state.bp).count("1")*100  #subtract black pawns (value 100)
-  score += bin(state.wr).count("1")*525  #white rooks (value 525)
-  score -= bin(state.br).count("1")*525  #black rooks (value 525)
-  score += bin(state.wn).count("1")*350  #white knights (350)
-  score -= bin(state.bn).count("1")*350  #black knights (350)
-  score += bin(state.wb).count("1")*350  #white bishop (350)
-  score -= bin(state.bb).count("1")*350  #black bishop (350)
-  score += bin(state.wb).count("1")*1000 #white queen (1000)
-  score -= bin(state.bb).count("1")*1000 #black queen (1000)
-  if(state.wk != 0): score += 100000 #white king (100,000)  (take the king instead of checkmating)
-  if(state.bk != 0): score -= 100000 #black king (100,000)
+  score = state.material # white's material minus black's, king included (take the king instead of checkmating)
+  if(FULL_EVAL): score += get_positional_score(state) # mobility and piece squares, also white's minus black's
   
-  if(not state.ai_color): score = -score #adjust to player color
+  if(not state.ai_color):
+   score = -score # adjust to player color
   
-  #incentivize trades by subtracting total piece count
-  score -= bin(state.get_all_pieces()).count('1') * 25
+  # incentivize trades by subtracting total piece count
+  score -= state.piece_count * 25
   
-  return score #return the result
+  return score # return the result
+
+# white's mobility and square bonuses minus black's, one piece at a time (evaluate_batch does the same for many)
+def get_positional_score(state):
+  white = state.get_white_pieces()
+  black = state.get_black_pieces()
+  occupied = white | black
+  score = 0
+  for piece in range(12):
+    kind = piece % 6
+    if(piece < 6): own, sign, flip = white, 1, 0
+    else: own, sign, flip = black, -1, 56 # black's squares mirrored onto white's tables
+    for square in ai.get_indexes(getattr(state, ai.PIECE_NAMES[piece])):
+      score += sign * SQUARE_BONUS[kind][square ^ flip]
+      if(kind == 2): attacks = ai.KNIGHT_ATTACKS[square]
+      elif(kind == 1): attacks = ai.rook_attacks(square, occupied)
+      elif(kind == 3): attacks = ai.bishop_attacks(square, occupied)
+      elif(kind == 4): attacks = ai.rook_attacks(square, occupied) | ai.bishop_attacks(square, occupied)
+      else: continue # pawns and kings don't count for mobility
+      score += sign * MOBILITY_WEIGHT * ai.popcount(attacks & ~own)
+  return score
+
+# set bits in every bitboard of an array (SWAR: bit pairs, then nibbles, then bytes, summed by the multiply)
+SWAR_CONSTANTS = [np.uint64(value) for value in (1, 2, 4, 56, 0x5555555555555555, 0x3333333333333333, 
+  0x0F0F0F0F0F0F0F0F, 0x0101010101010101)]
+def popcount_boards(boards):
+  one, two, four, top, pairs, nibbles, low_nibbles, bytes_sum = SWAR_CONSTANTS
+  boards = boards - ((boards >> one) & pairs)
+  boards = (boards & nibbles) + ((boards >> two) & nibbles)
+  boards = (boards + (boards >> four)) & low_nibbles
+  return ((boards * bytes_sum) >> top).astype(np.int64)
+
+# squares the sliders reach (one row of sliders per direction in steps), up to and including the first
+#   piece in the way, up the board or down it
+# Kogge-Stone fill: the sliders spread over empty squares 1, then 2, then 4 steps at a time (7 in three
+#   passes), then one more step takes them onto the blocker
+# pieces sliding the same way can't overlap (the ray behind stops on the one in front), so counting the
+#   result counts every piece's squares
+def slide_boards(sliders, empty, steps, up):
+  shift_1, shift_2, shift_4, masks = steps
+  if(up): shift = np.left_shift
+  else: shift = np.right_shift
+  open_squares = empty & masks # squares a step can land on without wrapping
+  flood = sliders | (open_squares & shift(sliders, shift_1))
+  open_squares = open_squares & shift(open_squares, shift_1)
+  flood |= open_squares & shift(flood, shift_2)
+  open_squares &= shift(open_squares, shift_2)
+  flood |= open_squares & shift(flood, shift_4)
+  return shift(flood, shift_1) & masks
+
+# score many positions at once, boards is an (N, 12) uint64 array (pack_boards), all from ai_color's side
+# same terms as get_state_evaluation with FULL_EVAL on: material, square bonuses, mobility and the trade
+#   incentive, done with byte table lookups and shifted bitboard floods
+# returns an array of N scores
+def evaluate_batch(boards, ai_color):
+  count = len(boards)
+  board_bytes = boards.astype('<u8').view(np.uint8).reshape(count, 96) # lowest squares first
+  score = BATCH_BYTE_SCORES[BATCH_BYTE_ROWS, board_bytes].sum(axis = 1, dtype = np.int64) # material and square bonuses
+  # mobility, white's boards then black's side by side so both go through the shifts together
+  own = np.concatenate((np.bitwise_or.reduce(boards[:, :6], axis = 1), np.bitwise_or.reduce(boards[:, 6:], axis = 1)))
+  empty = ~(own[:count] | own[count:])
+  empty = np.concatenate((empty, empty))
+  straight = np.concatenate((boards[:, 1] | boards[:, 4], boards[:, 7] | boards[:, 10])) # rooks and queens
+  diagonal = np.concatenate((boards[:, 3] | boards[:, 4], boards[:, 9] | boards[:, 10])) # bishops and queens
+  knights = np.concatenate((boards[:, 2], boards[:, 8]))
+  sliders = np.array((straight, straight, diagonal, diagonal))
+  reach = np.concatenate((slide_boards(sliders, empty, SLIDE_UP, True), slide_boards(sliders, empty, SLIDE_DOWN, False),
+    (knights << KNIGHT_UP[0]) & KNIGHT_UP[1], (knights >> KNIGHT_DOWN[0]) & KNIGHT_DOWN[1])) & ~own
+  mobility = popcount_boards(reach).sum(axis = 0)
+  score += MOBILITY_WEIGHT * (mobility[:count] - mobility[count:])
+  if(not ai_color): score = -score # adjust to player color
+  return score - popcount_boards(boards).sum(axis = 1) * 25 # incentivize trades
 
-#function returns a list of possible moves for a given state
-def get_possible_moves(state):
-  gen_moves = []  #empty list of move strings
-  append_move = gen_moves.append #store function reference (optimization)
+# pack states into the (N, 12) uint64 array evaluate_batch takes
+def pack_boards(states):
+  return np.array([get_boards(state) for state in states], dtype = np.uint64).reshape(-1, 12)
+
+# static scores for every move's position, in one batch (the depth-1 frontier, where most nodes are)
+def evaluate_children(state, move_list):
+  rows = []
+  for move in move_list:
+    undo = state.make_move(move)
+    rows.append(get_boards(state))
+    state.unmake_move(undo)
+  return evaluate_batch(np.array(rows, dtype = np.uint64).reshape(-1, 12), state.ai_color).tolist()
+
+# function returns a list of possible moves for a given state (as int moves, see ai.encode_move)
+# works on whole bitboards: targets come from the attack tables in chess_ai_defs and get walked
+#   one set bit at a time (x & -x is the lowest set bit)
+# captures_only leaves out castles and quiet moves (pushes to the last rank still count, for quiescence)
+def get_possible_moves(state, captures_only = False):
+  gen_moves = []  # empty list of moves
+  append_move = gen_moves.append # store function reference (optimization)
+  encode = ai.encode_move # same trick for the packer
   
-  #map to static lists so both sides can run the same function
-  if(state.turn == state.ai_color): #(ai color == white) !xor (turn == ai), white's turn
+  # map to static lists so both sides can run the same function
+  if(state.turn == state.ai_color): # (ai color == white) !xor (turn == ai), white's turn
     opponent_pieces = state.get_black_pieces()
     friendly_pieces = state.get_white_pieces()
     piece_list = [state.wp, state.wr, state.wn, state.wb, state.wq, state.wk]
-    pawn_dir = True   #pawns are moving forward
-  else: #black's turn
+    opponent_list = [state.bp, state.br, state.bn, state.bb, state.bq, state.bk]
+    offset = 0        # index of our pawns in ai.PIECE_NAMES
+    pawn_dir = True   # pawns are moving forward
+  else: # black's turn
     opponent_pieces = state.get_white_pieces()
     friendly_pieces = state.get_black_pieces()
     piece_list = [state.bp, state.br, state.bn, state.bb, state.bq, state.bk]
-    pawn_dir = False  #pawns move backwards
+    opponent_list = [state.wp, state.wr, state.wn, state.wb, state.wq, state.wk]
+    offset = 6
+    pawn_dir = False  # pawns move backwards
+  victim_offset = 6 - offset # index of the opponent's pawns
+  all_pieces = friendly_pieces | opponent_pieces
+  empty = ~all_pieces & ai.BOARD_MASK
   
-  #generate possible moves. Try moves more likely to resort in favorable situations first to improve search time
-  #check if castles are avaliable
-  if(state.ai_color and (state.castle & 1)):       #kingside castle
-    if(not ((friendly_pieces + opponent_pieces) & 0x0000000000000030)): #spaces f1,g1 must be clear
-      append_move("O-O")
-  if(state.ai_color and (state.castle & 2)):       #queenside castle
-    if(not ((friendly_pieces + opponent_pieces) & 0x000000000000000F)): #spaces b1,c1,d1 must be clear
-      append_move("O-O-O")
-  if(not state.ai_color and (state.castle & 4)):   #kingside castle
-    if(not ((friendly_pieces + opponent_pieces) & 0x3000000000000000)): #spaces f8,g8 must be clear
-      append_move("O-O")
-  if(not state.ai_color and (state.castle & 8)):   #queenside castle
-    if(not ((friendly_pieces + opponent_pieces) & 0x0F00000000000000)): #spaces b8,c8,d8 must be clear
-      append_move("O-O-O")
-
-  if(piece_list[0]): #check if there are pawns
-    rank_file = ai.get_rank_file(piece_list[0])
-    for piece in rank_file: #search for each piece found
-      pawn_square = ai.get_square(piece)
-      for r in (1, 2): #cycle through all avaliable angles of motion
-        if(not pawn_dir):
-          r = -1 * r  #invert pawn direction if we're black side
-        for f in (-1, 0, 1):
-          if(f != 0 and r == 2):
-            continue #can't move forward twice when changing rank
-          elif(f == 0 and (r == 2 or r == -2) and ((pawn_dir and piece[0] != 2) or (not pawn_dir and piece[0] != 7))):
-            continue #pawn can only move two spaces from starting row
-          if(piece[0]+r>0 and piece[0]+r<=8 and piece[1]+f>0 and piece[1]+f<=8): #check board boundaries
-            new_square = pawn_square
-            #shift as appropriate
-            if(r > 0): new_square = new_square << (r<<3)     #leftshift by 8 bits per row
-            elif(r < 0): new_square = new_square >> ((-r)<<3)  #rightshift (r<<3 = r*8)
-            if(f > 0): new_square = new_square << f     #<< by f
-            elif(f < 0): new_square = new_square >> -f  #>> by -f
-            #check for piece conflicts
-            if(not ((new_square & friendly_pieces) or (f == 0 and (new_square & (friendly_pieces + opponent_pieces))) or (f != 0 and not (new_square & opponent_pieces)))):
-              if(new_square & opponent_pieces + state.ep): capture = 'x' #piece captured
-              else: capture = '-' #no capture
-              #store the ouput string (old_location+capture+new_location)
-              move_string = "%s%s%s%s%s" % (chr(ord('a')+piece[1]-1),chr(ord('0')+piece[0]),capture,chr(ord('a')+piece[1]+f-1),chr(ord('0')+piece[0]+r))
-              append_move(move_string) #add it to the list
-
-  #get the knights's moves, search +-1/2 in rank, and map file to 1/2 as appropriate
-  if(piece_list[2]): #check if there is a knight
-    rank_file = ai.get_rank_file(piece_list[2])
-    for piece in rank_file: #search for each piece found
-      knight_square = ai.get_square(piece)
-      for r in (-2, -1, 1, 2): #cycle through all avaliable angles of motion
-        for f in (-1, 1):
-          if(r == -1 or r == 1):  #knight needs to 2-1 or 1-2, force this here
-            f = f * 2
-          if(piece[0]+(r)>0 and piece[0]+(r)<=8 and piece[1]+(f)>0 and piece[1]+(f) <=8): #check board boundaries
-            new_square = knight_square
-            #shift as appropriate
-            if(r > 0): new_square = new_square << (r<<3)     #leftshift by 8 bits per row (r<<3 = r*8)
-            elif(r < 0): new_square = new_square >> ((-r)<<3)  #rightshift 
-            if(f > 0): new_square = new_square << f     #<< by f
-            elif(f < 0): new_square = new_square >> -f  #>> by -f
-            if(not (new_square & friendly_pieces)): #no piece conflict
-              if(new_square & opponent_pieces + state.ep): capture = 'x' #piece captured
-              else: capture = '-' #no capture
-              #store the ouput string (N+old_location+capture+new_location)
-              move_string = "N%s%s%s%s%s" % (chr(ord('a')+piece[1]-1),chr(ord('0')+piece[0]),capture,chr(ord('a')+piece[1]+f-1),chr(ord('0')+piece[0]+r))
-              append_move(move_string) #add it to the list
-              if(new_square & opponent_pieces): #opponent piece
-                break #opposing peice on board
-            else:
-              break #friendly piece blocking us
-          else:
-            break #edge of board, nowhere else to go
- 
-  #get the rook's moves, search each direction till obstructed
-  if(piece_list[1]): #check if there is a rook
-    rank_file = ai.get_rank_file(piece_list[1])
-    for piece in rank_file: #search for each piece found
-      rook_square = ai.get_square(piece)
-      for r in (-1, 0, 1): #cycle through all avaliable angles of motion
-        for f in (-1, 1):
-          if(r != 0): #if we're moving vertically, don't move horizontally
-            if(f == -1): f = 0 #check vertical move
-            else: break #keep from checking a move multiple times
-          for i in range (1,8): #can move up to 7 squares
-            if(piece[0]+(r*i)>0 and piece[0]+(r*i)<=8 and piece[1]+(f*i)>0 and piece[1]+(f*i) <=8): #check board boundaries
-              new_square = rook_square
-              #shift as appropriate
-              if(r > 0): new_square = new_square << (i<<3)     #leftshift by 8 bits per row
-              elif(r < 0): new_square = new_square >> (i<<3)  #rightshift (i<<3 = i*8)
-              if(f > 0): new_square = new_square << i     #<< by f
-              elif(f < 0): new_square = new_square >> i   #>> by -f
-              if(not (new_square & friendly_pieces)):   #no piece conflict
-                if(new_square & opponent_pieces + state.ep): capture = 'x' #piece captured
-                else: capture = '-' #no capture
-                #store the ouput string (N+old_location+capture+new_location)
-                move_string = "R%s%s%s%s%s" % (chr(ord('a')+piece[1]-1),chr(ord('0')+piece[0]),capture,chr(ord('a')+piece[1]+f*i-1),chr(ord('0')+piece[0]+r*i))
-                append_move(move_string) #add it to the list
-                if(new_square & opponent_pieces): #opponent piece
-                  break #opposing peice on board
-              else:
-                break #friendly piece blocking us
-            else:
-              break #edge of board, nowhere else to go
-          if(f==0):
-            break #only need to check this condition once
-   
-  #get the bishop's moves, search each angle till obstructed
-  if(piece_list[3]): #check if there is a bishop
-    rank_file = ai.get_rank_file(piece_list[3])
-    for piece in rank_file: #search for each piece found
-      bishop_square = ai.get_square(piece)
-      for r in (-1, 1): #cycle through all avaliable angles of motion
-        for f in (-1, 1):
-          for i in range (1,8): #can move up to 7 squares
-            if(piece[0]+(r*i)>0 and piece[0]+(r*i)<=8 and piece[1]+(f*i)>0 and piece[1]+(f*i) <=8): #check board boundaries
-              new_square = bishop_square
-              #shift as appropriate
-              if(r > 0): new_square = new_square << (i<<3)    #leftshift by 8 bits per row
-              elif(r < 0): new_square = new_square >> (i<<3)  #rightshift (i<<3 = i*8)
-              if(f > 0): new_square = new_square << i     #<< by f
-              elif(f < 0): new_square = new_square >> i   #>> by -f
-              if(not (new_square & friendly_pieces)): #no piece conflict
-                if(new_square & opponent_pieces + state.ep): capture = 'x' #piece captured
-                else: capture = '-' #no capture
-                #store the ouput string (N+old_location+capture+new_location)
-                move_string = "B%s%s%s%s%s" % (chr(ord('a')+piece[1]-1),chr(ord('0')+piece[0]),capture,chr(ord('a')+piece[1]+f*i-1),chr(ord('0')+piece[0]+r*i))
-                append_move(move_string) #add it to the list
-                if(new_square & opponent_pieces): #opponent piece
-                  break #opposing peice on board
-              else:
-                break #friendly piece blocking us
-            else:
-              break #edge of board, nowhere else to go
-     
-   
-  #get the queen's moves, search in each direction/angle till blocked
-  if(piece_list[4]): #check if queen still exists
-    rank_file = ai.get_rank_file(piece_list[4])
-    for piece in rank_file: #search for each piece found (can have multiple queens)
-      queen_square = ai.get_square(piece)  #get the queen's location
-      for r in (-1,0,1): #cycle through all avaliable angles of motion
-        for f in (-1,0,1):
-          for i in range (1,8): #queen can move up to 7 squares
-            if(piece[0]+(r*i)>0 and piece[0]+(r*i)<=8 and piece[1]+(f*i)>0 and piece[1]+(f*i) <=8): #check board boundaries
-              new_square = queen_square
-              #shift as appropriate
-              if(r > 0): new_square = new_square << (i<<3)    #leftshift by 8 bits per row (8*i = i<<3)
-              elif(r < 0): new_square = new_square >> (i<<3)  #rightshift by 8*i
-              if(f > 0): new_square = new_square << i     #<< by f
-              elif(f < 0): new_square = new_square >> i   #>> by -f
-              if(not (new_square & friendly_pieces)): #no piece conflict
-                if(new_square & opponent_pieces + state.ep): capture = 'x' #piece captured
-                else: capture = '-' #no capture
-                #store the ouput string (N+old_location+capture+new_location)
-                move_string = "Q%s%s%s%s%s" % (chr(ord('a')+piece[1]-1),chr(ord('0')+piece[0]),capture,chr(ord('a')+piece[1]+f*i-1),chr(ord('0')+piece[0]+r*i))
-                append_move(move_string) #add it to the list
-                if(new_square & opponent_pieces): #opponent piece
-                  break #opposing piece
-              else:
-                break #friendly piece blocking us
-            else:
-              break #edge of board, nowhere else to go
-              
-  #add the king's moves (ignore checks, state eval will catch them eventually)
-  if(piece_list[5]): #check if king is still in play (suprisingly possible)
-    king_square = piece_list[5] #get the king's square
-    rank_file = ai.get_rank_file(king_square) #get the coordinates of the location
-    piece = rank_file[0] #only one king ever
-    for r in (-1,0,1): #king can move 1 space in any direction (+1,0,-1)
-      for f in (-1,0,1):
-        if(piece[0]+r>0 and piece[0]+r<=8 and piece[1]+f>0 and piece[1]+f <=8): #check board boundaries
-          new_square = king_square  #storage for new location
-          #shift as appropriate
-          if(r > 0): new_square = new_square << 8    #leftshift by 8 bits per row
-          elif(r < 0): new_square = new_square >> 8  #rightshift 
-          if(f > 0): new_square = new_square << 1    #<< by f
-          elif(f < 0): new_square = new_square >> 1  #>> by -f
-          if(not (new_square & friendly_pieces)): #no piece conflict
-            if(new_square & opponent_pieces + state.ep): capture = 'x' #piece captured
-            else: capture = '-' #no capture
-            #store the ouput string (N+old_location+capture+new_location)
-            move_string = "K%s%s%s%s%s" % (chr(ord('a')+piece[1]-1),chr(ord('0')+piece[0]),capture,chr(ord('a')+piece[1]+f-1),chr(ord('0')+piece[0]+r))
-            append_move(move_string) #add it to the list
+  # which enemy piece sits on a square we're capturing on
+  def victim(square):
+    for index in range(6):
+      if(opponent_list[index] & square): return index + victim_offset
+    return ai.NO_PIECE
+  
+  # generate possible moves. Try moves more likely to resort in favorable situations first to improve search time
+  # check if castles are avaliable
+  if(not captures_only):
+    if(pawn_dir and (state.castle & 1)):       # kingside castle
+      if(not (all_pieces & 0x0000000000000060)): # spaces f1,g1 must be clear
+        append_move(encode(4, 6, 5, ai.NO_PIECE, ai.MOVE_CASTLE_KING))
+    if(pawn_dir and (state.castle & 2)):       # queenside castle
+      if(not (all_pieces & 0x000000000000000E)): # spaces b1,c1,d1 must be clear
+        append_move(encode(4, 2, 5, ai.NO_PIECE, ai.MOVE_CASTLE_QUEEN))
+    if(not pawn_dir and (state.castle & 4)):   # kingside castle
+      if(not (all_pieces & 0x6000000000000000)): # spaces f8,g8 must be clear
+        append_move(encode(60, 62, 11, ai.NO_PIECE, ai.MOVE_CASTLE_KING))
+    if(not pawn_dir and (state.castle & 8)):   # queenside castle
+      if(not (all_pieces & 0x0E00000000000000)): # spaces b8,c8,d8 must be clear
+        append_move(encode(60, 58, 11, ai.NO_PIECE, ai.MOVE_CASTLE_QUEEN))
+
+  pawns = piece_list[0]
+  if(pawns): # check if there are pawns
+    # pushes for every pawn at once, shift the whole board a rank and keep what lands on empty squares
+    if(pawn_dir):
+      single = (pawns << 8) & empty
+      double = ((single & ai.RANK_3) << 8) & empty # second step from the starting rank
+      step = 8
+      pawn_attacks = ai.PAWN_ATTACKS[0]
+    else:
+      single = (pawns >> 8) & empty
+      double = ((single & ai.RANK_6) >> 8) & empty
+      step = -8
+      pawn_attacks = ai.PAWN_ATTACKS[1]
+    if(captures_only): # promotions only
+      single &= ai.LAST_RANKS
+      double = 0
+    while(single):
+      square = single & -single
+      single ^= square
+      new_index = square.bit_length() - 1
+      if(new_index >= 56 or new_index < 8): # last rank, pick a piece (queen first)
+        for promotion in (3, 0, 2, 1):
+          append_move(encode(new_index - step, new_index, offset, ai.NO_PIECE, ai.MOVE_PROMOTION | promotion))
+      else:
+        append_move(encode(new_index - step, new_index, offset))
+    while(double):
+      square = double & -double
+      double ^= square
+      new_index = square.bit_length() - 1
+      append_move(encode(new_index - step - step, new_index, offset, ai.NO_PIECE, ai.MOVE_DOUBLE_PUSH))
+    # captures, one pawn at a time from the attack table
+    targets_mask = opponent_pieces | state.ep
+    while(pawns):
+      square = pawns & -pawns
+      pawns ^= square
+      pawn_index = square.bit_length() - 1
+      targets = pawn_attacks[pawn_index] & targets_mask
+      while(targets):
+        square = targets & -targets
+        targets ^= square
+        new_index = square.bit_length() - 1
+        if(square & opponent_pieces): 
+          captured = victim(square)
+          flags = 0
+        else: # en passant
+          captured = victim_offset
+          flags = ai.MOVE_EN_PASSANT
+        if(new_index >= 56 or new_index < 8): # capture onto the last rank
+          for promotion in (3, 0, 2, 1):
+            append_move(encode(pawn_index, new_index, offset, captured, ai.MOVE_PROMOTION | promotion))
+        else:
+          append_move(encode(pawn_index, new_index, offset, captured, flags))
+
+  # everything else: attack table (or ray lookup) for the square, minus our own pieces
+  not_friendly = ~friendly_pieces & ai.BOARD_MASK
+  knight_attacks = ai.KNIGHT_ATTACKS
+  rook_attacks = ai.rook_attacks
+  bishop_attacks = ai.bishop_attacks
+  for piece_type in (2, 1, 3, 4, 5): # knights, rooks, bishops, queens, king
+    pieces = piece_list[piece_type]
+    while(pieces):
+      square = pieces & -pieces
+      pieces ^= square
+      old_index = square.bit_length() - 1
+      if(piece_type == 2): targets = knight_attacks[old_index]
+      elif(piece_type == 1): targets = rook_attacks(old_index, all_pieces)
+      elif(piece_type == 3): targets = bishop_attacks(old_index, all_pieces)
+      elif(piece_type == 4): targets = rook_attacks(old_index, all_pieces) | bishop_attacks(old_index, all_pieces)
+      else: targets = ai.KING_ATTACKS[old_index] # (ignore checks, state eval will catch them eventually)
+      targets &= not_friendly
+      captures = targets & opponent_pieces
+      if(captures_only): targets = 0
+      else: targets ^= captures
+      while(captures):
+        square = captures & -captures
+        captures ^= square
+        append_move(encode(old_index, square.bit_length() - 1, offset + piece_type, victim(square)))
+      while(targets):
+        square = targets & -targets
+        targets ^= square
+        append_move(encode(old_index, square.bit_length() - 1, offset + piece_type))
             
   return gen_moves
+
+# the possible moves that don't leave our own king in check, same arguments and move order as get_possible_moves
+# a piece pinned to our king may only move along the pin, in check everything but the king has to take the
+#   checker or step in its way (and only the king moves in double check), the king can't step onto an attacked
+#   square or castle out of, through or into check
+def get_legal_moves(state, captures_only = False):
+  white = (state.turn == state.ai_color)
+  if(white):
+    king = state.wk
+    friendly_pieces = state.get_white_pieces()
+    straight = state.br | state.bq # enemy sliders that pin along ranks and files
+    diagonal = state.bb | state.bq # and along diagonals
+  else:
+    king = state.bk
+    friendly_pieces = state.get_black_pieces()
+    straight = state.wr | state.wq
+    diagonal = state.wb | state.wq
+  king_index = king.bit_length() - 1
+  all_pieces = state.get_all_pieces()
+  checkers = state.get_attackers(king_index, not white, all_pieces)
+  
+  # pins: an enemy slider lined up with the king with exactly one piece between, and that piece is ours
+  pins = {} # pinned square -> squares it may still move to (the line up to and including the pinner)
+  pinners = (ai.ROOK_LINES[king_index] & straight) | (ai.BISHOP_LINES[king_index] & diagonal)
+  while(pinners):
+    pinner = pinners & -pinners
+    pinners ^= pinner
+    line = ai.BETWEEN[king_index][pinner.bit_length() - 1]
+    blockers = line & all_pieces
+    if(blockers and not (blockers & (blockers - 1)) and blockers & friendly_pieces):
+      pins[blockers.bit_length() - 1] = line | pinner
+  
+  if(checkers & (checkers - 1)): targets = 0 # double check, only the king can move
+  elif(checkers): # take the checker or block it
+    checker_index = checkers.bit_length() - 1
+    targets = checkers | ai.BETWEEN[king_index][checker_index]
+  else: targets = ai.BOARD_MASK
+  
+  legal_moves = []
+  append_move = legal_moves.append
+  without_king = all_pieces ^ king # the king doesn't block a slider it's stepping away from
+  moves = get_possible_moves(state, captures_only)
+  if(not checkers and not pins): # most positions, only the king's moves and en passant need a look
+    for move in moves:
+      if((move & 63) != king_index and (move >> 20) != ai.MOVE_EN_PASSANT): append_move(move)
+      elif(is_legal_special_move(state, move, white, without_king, checkers)): append_move(move)
+    return legal_moves
+  for move in moves:
+    old_index = move & 63
+    new_index = (move >> 6) & 63
+    flags = move >> 20
+    if(old_index == king_index or flags == ai.MOVE_EN_PASSANT):
+      if(is_legal_special_move(state, move, white, without_king, checkers)): append_move(move)
+    elif(not (targets >> new_index) & 1): continue # doesn't answer the check
+    elif(old_index in pins and not (pins[old_index] >> new_index) & 1): continue # leaves the pin
+    else: append_move(move)
+  return legal_moves
+
+# legality of a king move (castles included) or en passant capture, for get_legal_moves
+# the king can't step onto an attacked square (looked at without the king, so it can't hide from a slider
+#   behind itself) or castle out of, through or into check, en passant takes a pawn off a second square so
+#   it's just tried and looked at
+def is_legal_special_move(state, move, white, without_king, checkers):
+  flags = move >> 20
+  if(flags == ai.MOVE_EN_PASSANT):
+    undo = state.make_move(move)
+    if(white): legal = not state.is_square_attacked(state.wk.bit_length() - 1, False)
+    else: legal = not state.is_square_attacked(state.bk.bit_length() - 1, True)
+    state.unmake_move(undo)
+    return legal
+  new_index = (move >> 6) & 63
+  if(flags == ai.MOVE_CASTLE_KING or flags == ai.MOVE_CASTLE_QUEEN):
+    return not (checkers or state.is_square_attacked(((move & 63) + new_index) >> 1, not white) or 
+      state.is_square_attacked(new_index, not white))
+  return not state.get_attackers(new_index, not white, without_king)
   
-#Boo
+# Boo
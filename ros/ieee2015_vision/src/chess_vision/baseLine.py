@@ -2,17 +2,21 @@ import cv2
 import numpy as np
 import math
  
+#takes an image or the file name of one
 def findAngle(filename):
  
-    filename = filename
-    img = cv2.imread(filename)
-    gray = cv2.imread(filename, 0)
+    if isinstance(filename, str):
+        img = cv2.imread(filename)
+    else:
+        img = filename.copy()
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
  
     edges = cv2.Canny(gray,50,150,apertureSize = 3)
  
     lines = cv2.HoughLines(edges,1,np.pi/180,200)
      
-    rho, theta = lines[0][3]
+    #flattened because opencv 2 and opencv 3+ shape the lines differently
+    rho, theta = lines.reshape(-1, 2)[3]
     a = np.cos(theta)
     b = np.sin(theta)
     x0 = a*rho
@@ -4,7 +4,9 @@ from . import findCoordinates
 from . import Squares
 from . import edgechesshc
 from . import FindPiece
+import collections
 import cv2
+import numpy as np
 
 ##############This is handling Chess's vision################
 #only method that directly deal with image processing will be called from here
@@ -16,40 +18,220 @@ global x
 global y
 
 
+#every frame is brought to this size before anything else
+FRAME_SIZE = (640, 480)
+#pixels either side of a grid line that the drift check compares
+LINE_STEP = 3
+#how far (pixels) a grid line may wander before the board counts as moved (camera shake, vibration)
+DRIFT_TOLERANCE = 2
+#the board has moved when the grid lines are less than this fraction as sharp as when it was calibrated
+DRIFT_RATIO = 0.6
+#a square is classified again when its pixels differ from the reference by more than this on average
+#(per channel, 0-255), camera noise stays under it, a piece arriving or leaving goes over it
+CHANGE_THRESHOLD = 10
+#occupancy grids the vote looks back over (odd, so two values can't tie on their own)
+VOTE_FRAMES = 5
+#frames in a row the voted grid has to stay the same before it's reported as stable
+STABLE_FRAMES = 3
+
+
+#how sharp the grid lines are, returns (horizontal lines, vertical lines)
+#brightness step across every row and column inside the board (one array op per direction), then the
+#sharpest row or column within DRIFT_TOLERANCE of each line, median line of each direction
+#steps are over the board's contrast so a change in lighting doesn't look like the board moving
+def gridLineStrength(gray, rows, columns):
+    gray = gray.astype(np.int16)
+    left, right = columns[0], columns[-1]
+    top, bottom = rows[0], rows[-1]
+    step_rows = np.zeros(gray.shape[0])
+    step_rows[LINE_STEP:-LINE_STEP] = np.abs(gray[2 * LINE_STEP:, left:right] - gray[:-2 * LINE_STEP, left:right]).mean(axis=1)
+    step_columns = np.zeros(gray.shape[1])
+    step_columns[LINE_STEP:-LINE_STEP] = np.abs(gray[top:bottom, 2 * LINE_STEP:] - gray[top:bottom, :-2 * LINE_STEP]).mean(axis=0)
+    strengths = []
+    for steps, lines in ((step_rows, rows), (step_columns, columns)):
+        nearby = np.clip(lines[:, None] + np.arange(-DRIFT_TOLERANCE, DRIFT_TOLERANCE + 1), 0, len(steps) - 1)
+        strengths.append(np.median(steps[nearby].max(axis=1)))
+    contrast = max(gray[top:bottom, left:right].std(), 1.0)
+    return strengths[0] / contrast, strengths[1] / contrast
+
+
+#The board and camera don't move during a game, so the geometry (rotation, grid corners, square crops)
+#is worked out once and every later frame is just rotated with the saved matrix and classified
+#Each frame checks the grid lines are still where they were, if not it calibrates again
+#Only squares that look different from when they were last classified are classified again (a move
+#changes two to four), the rest keep their occupancy
+class ChessBoardTracker(object):
+    def __init__(self):
+        self.rotation = None  # 2x3 matrix for warpAffine
+        self.corners = None  # (9, 9, 2) (x, y) of every grid corner
+        self.rows = None  # y of the horizontal grid lines
+        self.columns = None  # x of the vertical grid lines
+        self.squares = None  # the 64 Squares, they crop the rotated frame
+        self.bounds = None  # (tops, bottoms, lefts, rights) arrays of the squares
+        self.reference = None  # rotated frame each square was last classified on
+        self.reference_strength = None  # grid line strength on the calibration frame
+        self.occupancy = None  # (8, 8) occupancy of the last frame
+        self.changed = np.arange(64)  # squares (0-63) whose occupancy the last frame changed
+        self.frames = 0
+        self.calibrations = 0
+
+    #work out the geometry from this frame, returns the rotated frame
+    def calibrate(self, img):
+        #Get the angle of rotation needed and rotate
+        theta = baseLine.findAngle(img)
+        self.rotation = Rotate.getRotationMatrix(theta, img)
+        rotatedImage = self.rotate(img)
+
+        #Find all the lines of the squares and the coordinates of the corners
+        lines = edgechesshc.addEdges(rotatedImage)
+        self.corners = findCoordinates.getCoordinates(lines)
+        self.columns = np.rint(self.corners[:, :, 0].mean(axis=0)).astype(int)
+        self.rows = np.rint(self.corners[:, :, 1].mean(axis=1)).astype(int)
+        self.squares = Squares.populateSquares(self.corners.reshape(-1, 2))
+        self.bounds = FindPiece.square_bounds(self.squares, *rotatedImage.shape[:2])
+        self.reference = None  # the squares moved, classify them all again
+
+        self.reference_strength = gridLineStrength(cv2.cvtColor(rotatedImage, cv2.COLOR_BGR2GRAY), self.rows, self.columns)
+        self.calibrations += 1
+        return rotatedImage
+
+    def rotate(self, img):
+        rows, cols = img.shape[:2]
+        return cv2.warpAffine(img, self.rotation, (cols, rows))
+
+    #True when the grid lines on the rotated frame aren't where the calibration found them
+    def hasDrifted(self, rotatedImage):
+        strength = gridLineStrength(cv2.cvtColor(rotatedImage, cv2.COLOR_BGR2GRAY), self.rows, self.columns)
+        return any(np.array(strength) < np.array(self.reference_strength) * DRIFT_RATIO)
+
+    #rotated frame, calibrating first if there's no calibration yet or the board moved
+    def rectify(self, img):
+        img = cv2.resize(img, FRAME_SIZE)
+        self.frames += 1
+        if self.rotation is None:
+            return self.calibrate(img)
+        rotatedImage = self.rotate(img)
+        if self.hasDrifted(rotatedImage):
+            print 'chess board moved, calibrating again'
+            return self.calibrate(img)
+        return rotatedImage
+
+    #mean absolute difference of each square from the reference, all 64 in one pass over the board
+    def squareDifferences(self, rotatedImage):
+        tops, bottoms, lefts, rights = self.bounds
+        top, bottom, left, right = tops.min(), bottoms.max(), lefts.min(), rights.max()
+        difference = cv2.absdiff(rotatedImage[top:bottom, left:right], self.reference[top:bottom, left:right])
+        sums = FindPiece.sum_in_squares(difference, tops - top, bottoms - top, lefts - left, rights - left)
+        areas = np.maximum((bottoms - tops) * (rights - lefts) * rotatedImage.shape[2], 1)
+        return sums / areas.astype(float)
+
+    #(8, 8) occupancy grid for one frame (0 empty, 1 orange, 2 blue)
+    #squares that haven't changed since they were last classified keep their occupancy
+    def update(self, img):
+        rotatedImage = self.rectify(img)
+        #calibrate() drops the reference when the board moves, this frame is read again on the new geometry
+        recalibrated = self.reference is None and self.occupancy is not None
+        if self.reference is None:
+            self.reference = rotatedImage.copy()
+            changed = np.arange(64)
+        else:
+            changed = np.flatnonzero(self.squareDifferences(rotatedImage) > CHANGE_THRESHOLD)
+        if self.occupancy is None:
+            previous = np.zeros(64, np.uint8)
+        else:
+            previous = self.occupancy.ravel()
+        occupancy = previous.copy()
+
+        if len(changed):
+            bounds = [side[changed] for side in self.bounds]
+            occupancy[changed] = FindPiece.classify_squares(rotatedImage, *bounds)
+            #these squares now compare against this frame
+            for top, bottom, left, right in zip(*bounds):
+                self.reference[top:bottom, left:right] = rotatedImage[top:bottom, left:right]
+
+        if recalibrated:
+            self.changed = np.array([], int)  # the reread is the new starting grid, not a move
+        else:
+            self.changed = np.flatnonzero(occupancy != previous)
+        self.occupancy = occupancy.reshape(8, 8)
+        return self.occupancy
+
+#One noisy frame can read a square wrong, which would look like a move to findDifferencesArrays
+#(and cost a search and an arm motion), so the grids from the last VOTE_FRAMES frames vote square by square,
+#and a new position is only reported once the voted grid has held for STABLE_FRAMES frames in a row
+#Listeners (functions taking the (8, 8) grid) are called when that happens, once per new position
+class OccupancyVoter(object):
+    def __init__(self, frames=VOTE_FRAMES, stable_frames=STABLE_FRAMES):
+        self.grids = collections.deque(maxlen=frames)  # ring buffer of the last (8, 8) grids
+        self.stable_frames = stable_frames
+        self.voted = None  # majority grid of the frames in the buffer
+        self.held = 0  # frames in a row the voted grid has been the same
+        self.stable = None  # last grid reported as stable
+        self.listeners = []
+
+    #call listener(grid) whenever a new stable grid comes up
+    def addListener(self, listener):
+        self.listeners.append(listener)
+
+    #majority value of each square over the buffered grids, a tie keeps the last voted value
+    def vote(self):
+        grids = np.array(self.grids)
+        votes = (grids[..., None] == np.arange(3)).sum(axis=0).astype(float)  # (8, 8, 3) counts of 0, 1, 2
+        if self.voted is not None:
+            votes[np.arange(8)[:, None], np.arange(8), self.voted] += 0.5
+        return votes.argmax(axis=2).astype(np.uint8)
+
+    #add one frame's grid (64 long or (8, 8)), returns the grid if this frame made a new stable position
+    #(and tells the listeners), None otherwise
+    def add(self, grid):
+        self.grids.append(np.array(grid, np.uint8).reshape(8, 8))
+        voted = self.vote()
+        if self.voted is not None and (voted == self.voted).all():
+            self.held += 1
+        else:
+            self.held = 1
+        self.voted = voted
+
+        if self.held < self.stable_frames:
+            return None
+        if self.stable is not None and (voted == self.stable).all():
+            return None  # already reported
+        self.stable = voted.copy()
+        for listener in self.listeners:
+            listener(self.stable)
+        return self.stable
+
+#one tracker shared by every call, so the calibration carries over between frames
+board_tracker = ChessBoardTracker()
+#votes on the tracker's grids for get_Stable_Occupancy
+occupancy_voter = OccupancyVoter()
+
+
 def get_Occupancy_and_Coordinates(img):
         ########################################################
         #this part needs to take in an image when Mission Planner tells it to
         #ergo it needs to be changed, or does mission planenr pass in a
         #ready to go image?
-        #
-        #filename = 'img'
-        #img = cv2.imread(filename)
-        #gray = cv2.imread(filename, 0)
         ########################################################
-        img = cv2.resize(img, (640, 480))
-        #Get the angle of rotation needed and rotate
-        #rotated image is really the thing we need because it will be the best final image to use
-        theta = baseLine.findAngle(img)
-        rotatedImage = Rotate.rotateImage(theta)
-
-        #Find all the lines of the squares
-        imgWithEdges = edgechesshc.addEdges(rotatedImage)
-
-        #Get all the coordinates of the keypoints
-        coordinates = findCoordinates.getCoordinates(imgWithEdges)
+        #rotation, grid and squares come from the tracker's calibration,
+        #which is only redone when the board has moved
+        new_occupancy_grid = board_tracker.update(img).ravel().tolist()
 
-        #Pass coordinates on to Squares
-        squares = Squares.populateSquares(coordinates)
+        #piece centers aren't worked out yet (FindPiece.determine_center)
+        array_of_coordinates = [[0, 0] for i in range(64)]
 
-        #believe this step is no longer necessary because of the architecture
-        #Load squares with their starting state
-        #Squares.loadPieces(squares, board_state)
+        return new_occupancy_grid, array_of_coordinates
 
-        squaresCropped = Squares.getSquaresCropped(squares, rotatedImage)
 
-        new_occupancy_grid, array_of_coordinates = FindPiece.main(squaresCropped)
+#Feed camera frames in here until the board settles, the AI and arm should only act on what this returns
+#returns the 64 long occupancy grid once it has read the same for a few frames (once per position),
+#None while it's still settling or hasn't changed (occupancy_voter.addListener to be called instead)
+def get_Stable_Occupancy(img):
+        stable_grid = occupancy_voter.add(board_tracker.update(img))
+        if stable_grid is None:
+            return None
 
-        return new_occupancy_grid, array_of_coordinates
+        return stable_grid.ravel().tolist()
 
 
 def giveForsythEdwardsNotation(board_state, w_or_b_turn):
@@ -93,11 +275,21 @@ def giveForsythEdwardsNotation(board_state, w_or_b_turn):
 
         ##########################################################End of creating board part of FE Notation###################################################
 
-def findDifferencesArrays(old_occupancy_grid, new_occupancy_grid, board_state):
+#changed is the squares (0-63) that differ between the grids, in order, e.g. board_tracker.changed,
+#left out it's worked out from the grids
+def findDifferencesArrays(old_occupancy_grid, new_occupancy_grid, board_state, changed=None):
     missingPiece = ''
     indexOfFound = -1
 
-    for i in range(0, 64):
+    #64 long lists or (8, 8) grids
+    old_occupancy_grid = np.ravel(old_occupancy_grid)
+    new_occupancy_grid = np.ravel(new_occupancy_grid)
+
+    #only squares whose occupancy changed can have anything to do with the move
+    if changed is None:
+        changed = np.flatnonzero(old_occupancy_grid != new_occupancy_grid)
+
+    for i in changed:
         #this first if statement should be called no matter what
         #for a piece to move or to make a kill
         #the piece must orignally be in a square and then
@@ -129,6 +321,8 @@ def findDifferencesArrays(old_occupancy_grid, new_occupancy_grid, board_state):
         elif (old_occupancy_grid[i] == 2 and new_occupancy_grid[i] == 1):
             indexOfFound = i
 
+    #the piece that left goes where a piece arrived
+    if indexOfFound != -1:
         board_state[indexOfFound] = missingPiece
 
     return board_state